@@ -15,10 +15,38 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+from importlib import import_module
+
 from .__version__ import __version__
-from .pirecorder import *
-from .camconfig import Camconfig
-from .convert import Convert
-from .schedule import Schedule
-from .stream import Stream
-from .videoin import VideoIn
+
+# Classes and functions are imported from their submodule on first use, so
+# that importing the package, e.g. to record, does not import opencv, crontab
+# or multiprocess unless they are needed
+_lazy = {"PiRecorder": "pirecorder", "rec": "pirecorder",
+         "Camconfig": "camconfig", "Convert": "convert",
+         "RecDaemon": "daemon", "recclient": "daemon",
+         "LiveView": "liveview", "Schedule": "schedule", "Stream": "stream",
+         "SyncAgent": "sync", "SyncCoordinator": "sync", "VideoIn": "videoin"}
+
+_submodules = ["camconfig", "camutils", "config", "convert", "daemon",
+               "frames", "liveview", "metrics", "motion", "offload",
+               "pirecorder", "preview", "rawarray", "schedule", "storage",
+               "stream", "sync", "timing", "videoin", "writer"]
+
+__all__ = list(_lazy)
+
+def __getattr__(name):
+
+    if name in _lazy:
+        value = getattr(import_module("."+_lazy[name], __name__), name)
+        globals()[name] = value
+        return value
+    if name in _submodules:
+        return import_module("."+name, __name__)
+
+    raise AttributeError("module "+repr(__name__)+" has no attribute "+repr(name))
+
+
+def __dir__():
+
+    return sorted(list(globals()) + list(_lazy) + _submodules)
@@ -0,0 +1,152 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2020 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from time import sleep, monotonic
+from fractions import Fraction
+from pythutils.mathutils import closenr
+
+def picamconv(resolution, maxres = (1632, 1232)):
+
+    """Adapts video resolution to work with raspberry pi camera. Same as
+    pythutils.mediautils.picamconv, without needing to import opencv"""
+
+    width = min(closenr(resolution[0],32), maxres[0])
+    height = min(closenr(resolution[1],16), maxres[1])
+
+    return (width, height)
+
+
+# Maximum exposure time in microseconds in sensor mode 3 per camera module
+MAXEXPOSURE = {"ov5647": 6000000, "imx219": 10000000, "imx477": 200000000}
+
+def longexposure(cam, shutterspeed, sensormode = 3):
+
+    """
+    Sets a sensor mode and framerate range that allow the provided long
+    shutterspeed, limited to the maximum exposure of the camera module.
+    Returns the shutterspeed that can be used in microseconds
+    """
+
+    maxexposure = MAXEXPOSURE.get(getattr(cam, "revision", None), 6000000)
+    shutterspeed = int(min(shutterspeed, maxexposure))
+    cam.sensor_mode = sensormode
+    cam.framerate_range = (Fraction(1000000, maxexposure),
+                           Fraction(1000000, shutterspeed))
+    cam.shutter_speed = shutterspeed
+
+    return shutterspeed
+
+
+class FrameCounter:
+
+    """
+    Output for unencoded yuv frames that only counts them, to keep a small
+    stream running on a splitter port for metering
+
+    Parameters
+    ----------
+    resolution : tuple
+        The (width, height) of the frames.
+    """
+
+    def __init__(self, resolution):
+
+        width, height = resolution
+        self.framesize = ((width+31)//32*32) * ((height+15)//16*16) * 3 // 2
+        self.nrbytes = 0
+
+
+    def write(self, buf):
+
+        self.nrbytes += len(buf)
+
+        return len(buf)
+
+
+    def flush(self):
+
+        pass
+
+
+    @property
+    def frames(self):
+
+        return self.nrbytes // self.framesize
+
+
+def camstate(cam):
+
+    """Returns the current exposure speed, analog and digital gain and the
+    red and blue white balance gains of the camera as a tuple of floats"""
+
+    red, blue = cam.awb_gains
+    return (float(cam.exposure_speed), float(cam.analog_gain),
+            float(cam.digital_gain), float(red), float(blue))
+
+
+def converge(cam, tol = 0.05, stable = 3, interval = 0.1, timeout = 10):
+
+    """
+    Polls the camera's exposure speed, gains and white balance gains until
+    they stay stable, i.e. stay within tol relative to the first poll of a
+    number of subsequent polls, or until the timeout is reached.
+
+    Parameters
+    ----------
+    cam : picamera.PiCamera
+        An opened camera with automatic exposure and white balance.
+    tol : float, default = 0.05
+        Maximum relative deviation from the first stable poll.
+    stable : int, default = 3
+        Number of subsequent polls that need to be within tolerance.
+    interval : float, default = 0.1
+        Time in seconds between polls.
+    timeout : float, default = 10
+        Maximum time in seconds to wait for the camera to converge.
+
+    Returns
+    -------
+    converged : bool
+        If the camera settled within the timeout.
+    elapsed : float
+        Time in seconds it took to converge or to time out.
+    polls : int
+        The number of polls done.
+    """
+
+    start = monotonic()
+    reference = None
+    nrstable = 0
+    polls = 0
+
+    while True:
+        state = camstate(cam)
+        polls += 1
+        if reference is not None and state[0] > 0:
+            diffs = [abs(s-r)/max(abs(r), 1e-6) for s, r in zip(state, reference)]
+            if max(diffs) <= tol:
+                nrstable += 1
+            else:
+                reference, nrstable = state, 0
+        else:
+            reference = state
+        elapsed = monotonic() - start
+        if nrstable >= stable:
+            return True, elapsed, polls
+        if elapsed + interval > timeout:
+            return False, elapsed, polls
+        sleep(interval)
@@ -0,0 +1,294 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2020 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import pickle
+
+from ast import literal_eval
+from configparser import ConfigParser
+
+SECTIONS = ["rec","cam","cus","img","vid"]
+
+CHOICES = {"rectype": ["img","imgseq","imgraw","vid","vidseq","vidmotion"],
+           "warmup": ["fixed","converge"],
+           "overrun": ["skip","catchup"],
+           "writepolicy": ["block","dropoldest","spill"],
+           "vidformat": ["h264","mp4"],
+           "preview": [None,False,"mjpeg","bgr"],
+           "rawformat": ["gray","bgr"],
+           "preflight": [None,False,"warn","fallback"],
+           "dropaction": [None,"alert","abort"]}
+NUMBERS = ["rotation","brighttune","brightness","contrast","saturation","iso",
+           "sharpness","compensation","shutterspeed","imgfps","vidfps",
+           "imgwait","imgnr","imgtime","imgquality","vidduration","viddelay",
+           "vidquality","writequeue","vidsegment","motionpre","motionpost",
+           "motionthresh","liveview","dropthresh","offloadrate"]
+BOOLS = ["subdirs","automode","burst","motionvectors","frametimes","metrics"]
+TUPLES = ["imgdims","viddims","previewdims","gains","roi"]
+TEXT = ["recdir","label","offload","promfile"]
+
+# Version of the parsed values stored in snapshots, so that snapshots parsed
+# differently by an older version are parsed again
+SNAPSHOT = 2
+
+_snapshots = {}
+
+def _atomicwrite(filename, data, mode = "w"):
+
+    """Writes data to a temporary file that then replaces filename, so that
+    filename is never left partially written"""
+
+    tmpfile = filename+".tmp"
+    with open(tmpfile, mode) as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmpfile, filename)
+
+
+def typed(value):
+
+    """Converts a configuration file string to its python value"""
+
+    low = value.lower()
+    if low == "none":
+        return None
+    if low in ["true","yes","on"]:
+        return True
+    if low in ["false","no","off"]:
+        return False
+    for totype in [int, float]:
+        try:
+            return totype(value)
+        except ValueError:
+            pass
+    if value[:1] in ["(","["]:
+        try:
+            return literal_eval(value)
+        except (ValueError, SyntaxError):
+            pass
+
+    return value
+
+
+def validate(key, value):
+
+    """Returns the value with the right type for key, raising a ValueError if
+    it is not valid. Values of free-text keys are kept as strings"""
+
+    if key in TEXT:
+        return value if value is None else str(value)
+    if isinstance(value, str):
+        value = typed(value)
+    if isinstance(value, list):
+        value = tuple(value)
+
+    if key in CHOICES and value not in CHOICES[key]:
+        raise ValueError(key+" should be one of "+str(CHOICES[key])+", not "+\
+                         repr(value))
+    if key in NUMBERS and (isinstance(value, bool) or \
+       not isinstance(value, (int, float))):
+        raise ValueError(key+" should be a number, not "+repr(value))
+    if key in BOOLS and not isinstance(value, bool):
+        raise ValueError(key+" should be True or False, not "+repr(value))
+    if key in TUPLES and value is not None and not (isinstance(value, tuple) \
+       and all(isinstance(v, (int, float)) for v in value)):
+        raise ValueError(key+" should be a tuple of numbers, not "+repr(value))
+
+    return value
+
+
+class Section:
+
+    """Attribute access to the typed values of a configuration section, with
+    None for values that are not set"""
+
+    def __init__(self, config, name):
+
+        object.__setattr__(self, "_config", config)
+        object.__setattr__(self, "_name", name)
+
+
+    def __getattr__(self, key):
+
+        return self._config.values[self._name].get(key)
+
+
+    def __setattr__(self, key, value):
+
+        self._config.values[self._name][key] = validate(key, value)
+
+
+    def __iter__(self):
+
+        return iter(self._config.values[self._name].items())
+
+
+class Config:
+
+    """
+    Typed configuration of the recorder that is parsed and validated once.
+    The parsed values are stored as a snapshot next to the configuration file
+    that is loaded instead of the configuration file for as long as the file
+    has not been modified, so that no strings need to be evaluated when the
+    recorder is started. Values are accessed per section, for example with
+    config.vid.viddims, and missing values are None.
+
+    Parameters
+    ----------
+    configfile : str
+        The configuration file, which does not need to exist yet.
+    """
+
+    def __init__(self, configfile):
+
+        self.configfile = configfile
+        folder, name = os.path.split(configfile)
+        self.cachefile = os.path.join(folder, "."+name+".cache")
+        self.values = {}
+        self.mtime = None
+        self.saved = None
+        self.load()
+
+
+    def _stamp(self):
+
+        try:
+            stat = os.stat(self.configfile)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+
+    def load(self):
+
+        """Loads the configuration, from the snapshot if it is up to date"""
+
+        stamp = self._stamp()
+        if stamp is None:
+            self.values = {}
+            self.mtime = None
+            self.saved = None
+            return
+
+        snapshot = _snapshots.get(self.configfile)
+        if snapshot is None and os.path.isfile(self.cachefile):
+            try:
+                with open(self.cachefile, "rb") as f:
+                    snapshot = pickle.load(f)
+            except Exception:
+                snapshot = None
+        if snapshot is None or snapshot[0] != stamp or snapshot[-1] != SNAPSHOT:
+            snapshot = (stamp, self._parse(), SNAPSHOT)
+            self._cache(snapshot)
+        _snapshots[self.configfile] = snapshot
+
+        self.values = {s: dict(v) for s, v in snapshot[1].items()}
+        self.mtime = stamp
+        self.saved = self.text()
+
+
+    def _cache(self, snapshot):
+
+        try:
+            _atomicwrite(self.cachefile, pickle.dumps(snapshot,
+                         pickle.HIGHEST_PROTOCOL), mode = "wb")
+        except OSError:
+            pass
+
+
+    def _parse(self):
+
+        parser = ConfigParser(interpolation = None)
+        parser.optionxform = str
+        parser.read(self.configfile)
+        values = {}
+        for section in parser.sections():
+            values[section] = {}
+            for key, value in parser.items(section):
+                if key in TEXT:
+                    values[section][key] = None if value == "None" else value
+                    continue
+                try:
+                    values[section][key] = validate(key, value)
+                except ValueError:
+                    values[section][key] = typed(value)
+
+        return values
+
+
+    def changed(self):
+
+        """Returns if the configuration file was modified since loading"""
+
+        return self._stamp() != self.mtime
+
+
+    def __getattr__(self, section):
+
+        if section not in self.values:
+            raise AttributeError(section)
+
+        return Section(self, section)
+
+
+    def __iter__(self):
+
+        return iter(list(self.values))
+
+
+    def add_section(self, section):
+
+        self.values.setdefault(section, {})
+
+
+    def text(self):
+
+        """Returns the configuration as it is stored in the file"""
+
+        lines = []
+        for section, values in self.values.items():
+            lines.append("["+section+"]")
+            lines.extend(key+" = "+str(value) for key, value in values.items())
+            lines.append("")
+
+        return "\n".join(lines[:-1])
+
+
+    def copy(self):
+
+        """Returns a copy of the configuration values"""
+
+        return {s: dict(v) for s, v in self.values.items()}
+
+
+    def save(self):
+
+        """Atomically stores the configuration in the file and updates the
+        snapshot, unless nothing changed. Returns if the file was written"""
+
+        text = self.text()
+        if text == self.saved and not self.changed():
+            return False
+        _atomicwrite(self.configfile, text)
+        self.mtime = self._stamp()
+        self.saved = text
+        snapshot = (self.mtime, self.copy(), SNAPSHOT)
+        _snapshots[self.configfile] = snapshot
+        self._cache(snapshot)
+
+        return True
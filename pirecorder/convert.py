@@ -24,17 +24,85 @@ import sys
 import time
 import glob
 import argparse
+import tempfile
 import subprocess
 
 from threading import Thread
 from multiprocess import Pool
+from concurrent.futures import ThreadPoolExecutor
 from pythutils.sysutils import lineprint
-from pythutils.drawutils import draw_text
 from pythutils.fileutils import listfiles, get_ext, commonpref, move
 from pythutils.mediautils import get_vid_params, videowriter, imgresize
 
+from .frames import readframes, framestats
+
 class KeyboardInterruptError(Exception): pass
 
+def runffmpeg(comm, name, nrframes = None, interval = 2, procs = None):
+
+    """
+    Runs an ffmpeg command provided as a list of arguments, without a shell,
+    and logs its progress parsed from ffmpeg's progress output every interval
+    seconds, with the remaining time if the total number of frames is known.
+    Running processes are added to the procs set if provided, so that they
+    can be stopped. Returns the wall and cpu time of the process in seconds,
+    the number of frames processed, and the error message if ffmpeg failed
+    """
+
+    comm = [comm[0], "-progress", "pipe:1", "-nostats", "-loglevel", "error"] + \
+           list(comm[1:])
+    errors = tempfile.TemporaryFile()
+    start = time.monotonic()
+    try:
+        proc = subprocess.Popen(comm, stdin = subprocess.DEVNULL,
+                                stdout = subprocess.PIPE, stderr = errors,
+                                universal_newlines = True)
+    except OSError as e:
+        errors.close()
+        return {"wall": time.monotonic() - start, "frames": 0, "cpu": 0.,
+                "error": "could not start "+comm[0]+" (%s)" % e}
+    if procs is not None:
+        procs.add(proc)
+
+    progress = {}
+    frames = 0
+    last = start
+    for line in proc.stdout:
+        key, _, value = line.strip().partition("=")
+        progress[key] = value.strip()
+        if key != "progress":
+            continue
+        try:
+            frames = int(progress.get("frame", 0))
+            fps = float(progress.get("fps", 0))
+        except ValueError:
+            continue
+        now = time.monotonic()
+        if value == "end" or now - last < interval:
+            continue
+        last = now
+        msg = name+": "+str(frames)+(" of "+str(nrframes) if nrframes else "")+\
+              " frames, "+str(round(fps))+" fps"
+        if nrframes and fps > 0:
+            msg += ", ETA "+str(round(max(0, nrframes-frames)/fps))+"s"
+        lineprint(msg, label="pirecorder")
+
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) \
+                      else -os.WTERMSIG(status)
+    if procs is not None:
+        procs.discard(proc)
+    error = None
+    if proc.returncode != 0:
+        errors.seek(0)
+        lines = errors.read().decode(errors = "replace").strip().split("\n")
+        error = lines[-1] or "exit status "+str(proc.returncode)
+    errors.close()
+
+    return {"wall": time.monotonic() - start, "frames": frames,
+            "cpu": usage.ru_utime + usage.ru_stime, "error": error}
+
+
 class Convert:
 
     """
@@ -42,6 +110,8 @@ class Convert:
     media, write the unique frame number on each frame, and continuously monitor
     a folder for updated files. Multiple files can be converted simultaneously
     with the pools parameter to optimally use the computer's processing cores.
+    Videos are converted by ffmpeg processes that are started without a shell,
+    with their progress and the wall and cpu time per file logged.
 
     Parameters
     -----------
@@ -57,9 +127,10 @@ class Convert:
         OpenCV to draw the frame number on each video frame.
     delete : bool, default = False
         If the original videos should be deleted or not.
-    pools : int, default = 4
+    pools : int, default = None
         Number of simultaneous converting processing that should be allowed.
-        Works optimally when equal to the number of computer processing cores.
+        Works optimally when equal to the number of computer processing cores,
+        which is used by default.
     resizeval : float, default = 1
         Float value to which the video should be resized.
     imgfps : int, default = 25
@@ -67,12 +138,14 @@ class Convert:
     sleeptime : int, default = None
         Time in seconds between subsequent checks for files within a folder. The
         default value (None) only converts the current files.
+    ffmpeg : str, default = "ffmpeg"
+        The ffmpeg executable to use.
     """
 
     def __init__(self, indir = "", outdir = "", type = ".h264",
                  withframe = False, overwrite = False, delete = False,
-                 pools = 4, resizeval = 1, fps = None, imgfps = 25,
-                 internal = False, sleeptime = None):
+                 pools = None, resizeval = 1, fps = None, imgfps = 25,
+                 internal = False, sleeptime = None, ffmpeg = "ffmpeg"):
 
         if internal:
             lineprint("Running convert function..", label="pirecorder")
@@ -89,7 +162,9 @@ class Convert:
         self.type = type
         self.withframe = withframe
         self.delete = delete
-        self.pools = int(pools)
+        self.pools = int(pools) if pools else (os.cpu_count() or 1)
+        self.ffmpeg = ffmpeg
+        self.procs = set()
         self.resizeval = float(resizeval)
         self.fps = int(fps) if fps is not None else None
         self.imgfps = int(imgfps)
@@ -119,6 +194,53 @@ class Convert:
                     lineprint("Terminating checking for files..", label="pirecorder")
                     return
 
+    def _fps(self, filein):
+
+        """Returns the framerate and number of frames of a video from its
+        frame sidecar file if available"""
+
+        framefile = filein[:-len(self.type)]+"_frames.bin"
+        if not os.path.isfile(framefile):
+            return self.fps, None
+        stats = framestats(readframes(framefile))
+        fps = self.fps if self.fps is not None else (stats["fps"] or None)
+
+        return fps, stats["frames"]
+
+
+    def conv_ffmpeg(self, filein):
+
+        """Converts a video to mp4 with ffmpeg and returns the wall and cpu
+        time it took"""
+
+        filebase = os.path.basename(filein)
+        fileout = filein if self.outdir == "" else self.outdir+"/"+filebase
+        lineprint("Start converting "+filebase, label="pirecorder")
+
+        fps, nrframes = self._fps(filein)
+        comm = [self.ffmpeg, "-y"]
+        if fps is not None:
+            comm += ["-r", str(fps)]
+        comm += ["-i", filein]
+        if self.resizeval != 1:
+            comm += ["-vf", "scale=iw*"+str(self.resizeval)+":-2"]
+        else:
+            comm += ["-vcodec", "copy"]
+        comm += [fileout[:-len(self.type)]+".mp4"]
+
+        result = runffmpeg(comm, filebase, nrframes, procs = self.procs)
+        if result["error"] is not None:
+            lineprint("Converting "+filebase+" failed: "+result["error"],
+                      label="pirecorder")
+        else:
+            lineprint("Finished converting "+filebase+" ("+\
+                      str(result["frames"])+" frames) in "+\
+                      str(round(result["wall"],2))+"s, cpu "+\
+                      str(round(result["cpu"],2))+"s", label="pirecorder")
+
+        return filein, result
+
+
     def conv_single(self, filein):
 
         try:
@@ -126,36 +248,26 @@ class Convert:
             fileout = filein if self.outdir == "" else self.outdir+"/"+filebase
             lineprint("Start converting "+filebase, label="pirecorder")
 
-            if self.withframe:
-                vid = cv2.VideoCapture(filein)
-                fps, width, height, _ = get_vid_params(vid)
-                if self.fps is None:
-                    self.fps = fps
-                vidout = videowriter(fileout, width, height, self.fps, self.resizeval)
-
-                while True:
-                    flag, frame = vid.read()
-                    if flag:
-                        if self.resizeval != 1:
-                            frame = imgresize(frame, self.resizeval)
-                        frame_nr = int(vid.get(cv2.CAP_PROP_POS_FRAMES))
-                        draw_text(frame, str(frame_nr), (10,10), 0.9, col="white",
-                                  shadow=True)
-                        vidout.write(frame)
-                    if not flag:
-                        break
+            fps, _ = self._fps(filein)
 
-            else:
-                if self.resizeval != 1:
-                    comm = "' -vf 'scale=iw*" + str(self.resizeval) + ":-2' '"
-                else:
-                    comm = "' -vcodec copy '"
-                bashcomm = "ffmpeg"
-                if self.fps is not None:
-                    bashcomm = bashcomm+" -r "+ str(self.fps)
-                bashcomm = bashcomm+" -i '"+filein+comm+fileout[:-len(self.type)]+".mp4'"
-                bashcomm = bashcomm + " -y -nostats -loglevel 0"
-                output = subprocess.check_output(['bash','-c', bashcomm])
+            from pythutils.drawutils import draw_text
+
+            vid = cv2.VideoCapture(filein)
+            vidfps, width, height, _ = get_vid_params(vid)
+            fps = vidfps if fps is None else fps
+            vidout = videowriter(fileout, width, height, fps, self.resizeval)
+
+            while True:
+                flag, frame = vid.read()
+                if flag:
+                    if self.resizeval != 1:
+                        frame = imgresize(frame, self.resizeval)
+                    frame_nr = int(vid.get(cv2.CAP_PROP_POS_FRAMES))
+                    draw_text(frame, str(frame_nr), (10,10), 0.9, col="white",
+                              shadow=True)
+                    vidout.write(frame)
+                if not flag:
+                    break
 
             lineprint("Finished converting "+filebase, label="pirecorder")
 
@@ -163,11 +275,50 @@ class Convert:
             raise KeyboardInterruptError()
 
 
+    def ffmpegpool(self):
+
+        """Converts all videos with a pool of ffmpeg processes and returns the
+        videos that were converted successfully"""
+
+        start = time.monotonic()
+        pool = ThreadPoolExecutor(max_workers = min(self.pools, len(self.todo)))
+        jobs = [pool.submit(self.conv_ffmpeg, f) for f in self.todo]
+        try:
+            results = [job.result() for job in jobs]
+        except KeyboardInterrupt:
+            lineprint("User terminated converting pool..", label="pirecorder")
+            self.terminated = True
+            for job in jobs:
+                job.cancel()
+            for proc in list(self.procs):
+                proc.terminate()
+            pool.shutdown()
+            return []
+        pool.shutdown()
+
+        done = [f for f, r in results if r["error"] is None]
+        lineprint("Done converting "+str(len(done))+" of "+str(len(results))+\
+                  " videofiles in "+str(round(time.monotonic()-start,2))+\
+                  "s, cpu "+str(round(sum(r["cpu"] for _, r in results),2))+\
+                  "s!", label="pirecorder")
+
+        return done
+
+
     def convertpool(self):
 
         if len(self.todo) > 0:
 
-            if self.type in [".h264",".mp4",".avi"]:
+            if self.type in [".h264",".mp4",".avi"] and not self.withframe:
+
+                done = self.ffmpegpool()
+                if self.delete and not self.terminated:
+                    for filein in done:
+                        os.remove(filein)
+                    lineprint("Deleted "+str(len(done))+" original videofiles..",
+                              label="pirecorder")
+
+            elif self.type in [".h264",".mp4",".avi"]:
 
                 pool = Pool(min(self.pools, len(self.todo)))
                 try:
@@ -226,7 +377,7 @@ def conv():
     parser.add_argument("-t", "--type", default=".h264", metavar="")
     parser.add_argument("-w", "--withframe", default="False", metavar="")
     parser.add_argument("-d", "--delete", default="False", metavar="")
-    parser.add_argument("-p", "--pools", default=4, type=int, metavar="")
+    parser.add_argument("-p", "--pools", default=None, type=int, metavar="")
     parser.add_argument("-r", "--resizeval", default=1, type=float, metavar="")
     parser.add_argument("-f", "--imgfps", default=25, type=int, metavar="")
     parser.add_argument("-s", "--sleeptime", default=None, type=int, metavar="")
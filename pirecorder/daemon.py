@@ -0,0 +1,289 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2020 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import print_function
+
+import os
+import json
+import time
+import socket
+import argparse
+import threading
+
+from datetime import datetime
+from pythutils.sysutils import lineprint, homedir, isrpi
+
+def sendjson(conn, message):
+
+    """Sends message over the socket conn as a single line of json"""
+
+    conn.sendall((json.dumps(message)+"\n").encode())
+
+
+def recvjson(stream):
+
+    """Reads a single line of json from stream, a file object of a socket as
+    returned by its makefile method, or returns None if the connection was
+    closed"""
+
+    line = stream.readline()
+
+    return json.loads(line.decode()) if line else None
+
+
+def sockfile():
+
+    """Returns the default location of the recorder daemon socket"""
+
+    return homedir() + "pirecorder/recorder.sock"
+
+
+class RecDaemon:
+
+    """
+    Resident recorder process that keeps the camera open and warmed up so that
+    recordings can be started without the overhead of importing all packages,
+    loading the configuration and warming up the camera for every recording.
+    Recordings are started by connecting to the daemon with the recclient
+    function, which is what scheduled jobs call when created with the daemon
+    parameter, or by the daemon itself when provided with a timeplan.
+
+    Parameters
+    ----------
+    configfile : str, default = "pirecorder.conf"
+        The name of the configuration file to be used for recordings. When a
+        client requests a recording with a different configuration file, or
+        when the configuration file has changed, the recorder is reloaded and
+        the camera set up again.
+    socketfile : str, default = None
+        The unix socket the daemon listens on. By default the socket is stored
+        in the pirecorder setup directory.
+    timeplan : str, default = None
+        An optional CRON timeplan with which the daemon will start recordings
+        by itself, without the need for cron jobs.
+    logging : bool, default = True
+        If all terminal output should be stored in the pirecorder log file.
+
+    Example
+    -------
+    On the raspberry pi, start the daemon (e.g. at boot) with:
+    >>> recdaemon --configfile "pirecorder.conf"
+    and start a recording with minimal delay from another process with:
+    >>> pirecorder.recclient("pirecorder.conf")
+    """
+
+    def __init__(self, configfile = "pirecorder.conf", socketfile = None,
+                 timeplan = None, logging = True):
+
+        self.configfile = configfile
+        self.socketfile = sockfile() if socketfile is None else socketfile
+        self.timeplan = timeplan
+        self.logging = logging
+
+        self.rec = None
+        self.lock = threading.Lock()
+        self.stopped = False
+        self.nrrecs = 0
+
+        self._load(configfile)
+
+
+    def _load(self, configfile):
+
+        """(Re)loads the recorder and sets up and warms up the camera"""
+
+        from .pirecorder import PiRecorder
+
+        if self.rec is not None:
+            self.rec.close()
+        self.rec = PiRecorder(configfile, logging = self.logging)
+        self.logging = False
+        self.configfile = configfile
+        self.rec.settings(internal = True)
+        self.mtime = os.path.getmtime(self.rec.configfile)
+        self.rec._setup_cam()
+        lineprint("Camera ready for recording with "+configfile+"..")
+
+
+    def record(self, configfile = None):
+
+        """Starts a recording with the warm camera, reloading if needed"""
+
+        configfile = self.configfile if configfile is None else configfile
+        with self.lock:
+            start = time.time()
+            if configfile != self.configfile or \
+               os.path.getmtime(self.rec.configfile) != self.mtime:
+                lineprint("Configuration changed, reloading recorder..")
+                self._load(configfile)
+            if self.rec.config.rec.rectype == "vidseq" and \
+               not self.rec.config.vid.vidsegment:
+                lineprint("vidseq recordings need vidsegment with the daemon..")
+                return {"status": "error", "message": "vidseq not supported"}
+            self.rec.settings(internal = True)
+            self.mtime = os.path.getmtime(self.rec.configfile)
+            delay = round(time.time() - start, 3)
+            self.rec.record(keepopen = True)
+            self.nrrecs += 1
+
+        return {"status": "ok", "delay": delay}
+
+
+    def _handle(self, conn):
+
+        """Handles a single client request"""
+
+        try:
+            with conn.makefile("rb") as stream:
+                request = recvjson(stream)
+            cmd = request.get("cmd", "record")
+            if cmd == "record":
+                reply = self.record(request.get("configfile"))
+            elif cmd == "status":
+                reply = {"status": "ok", "configfile": self.configfile,
+                         "recordings": self.nrrecs}
+            elif cmd == "stop":
+                self.stopped = True
+                reply = {"status": "ok"}
+            else:
+                reply = {"status": "error", "message": "unknown command"}
+        except Exception as e:
+            lineprint("Failed handling request: %r.." % (e,))
+            reply = {"status": "error", "message": repr(e)}
+
+        try:
+            sendjson(conn, reply)
+        except socket.error:
+            pass
+        conn.close()
+
+
+    def _timer(self):
+
+        """Starts recordings by itself according to the timeplan"""
+
+        from croniter import croniter
+
+        plan = croniter(self.timeplan, datetime.now())
+        while not self.stopped:
+            nextrec = plan.get_next(datetime)
+            lineprint("Next recording at "+str(nextrec)+"..")
+            while not self.stopped and datetime.now() < nextrec:
+                time.sleep(min(0.5, (nextrec-datetime.now()).total_seconds()))
+            if not self.stopped:
+                try:
+                    self.record()
+                except Exception as e:
+                    lineprint("Scheduled recording failed: %r.." % (e,))
+
+
+    def run(self):
+
+        """Serves recording requests until stopped"""
+
+        if os.path.exists(self.socketfile):
+            os.remove(self.socketfile)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.socketfile)
+        self.server.listen(5)
+        self.server.settimeout(0.5)
+
+        if self.timeplan is not None:
+            threading.Thread(target = self._timer, daemon = True).start()
+
+        lineprint("Recorder daemon listening on "+self.socketfile+"..")
+        try:
+            while not self.stopped:
+                try:
+                    conn, _ = self.server.accept()
+                except socket.timeout:
+                    continue
+                conn.settimeout(None)
+                self._handle(conn)
+        except KeyboardInterrupt:
+            lineprint("User terminated daemon..")
+        finally:
+            self.stop()
+
+
+    def stop(self):
+
+        """Stops the daemon and releases the camera"""
+
+        self.stopped = True
+        with self.lock:
+            self.rec.close()
+        self.server.close()
+        if os.path.exists(self.socketfile):
+            os.remove(self.socketfile)
+        lineprint("Recorder daemon stopped..")
+
+
+def recclient(configfile = "pirecorder.conf", cmd = "record",
+              socketfile = None, fallback = True):
+
+    """
+    Requests a recording from a running recorder daemon. If no daemon is
+    running and fallback is True the recording is run directly instead
+    """
+
+    socketfile = sockfile() if socketfile is None else socketfile
+
+    try:
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(socketfile)
+    except socket.error:
+        if not fallback or cmd != "record":
+            lineprint("No recorder daemon running..")
+            return {"status": "error", "message": "no daemon"}
+        lineprint("No recorder daemon running, recording directly..")
+        from .pirecorder import PiRecorder
+        rec = PiRecorder(configfile)
+        rec.settings(internal = True)
+        rec.record()
+        return {"status": "ok", "delay": None}
+
+    sendjson(conn, {"cmd": cmd, "configfile": configfile})
+    with conn.makefile("rb") as stream:
+        reply = recvjson(stream) or {"status": "error"}
+    conn.close()
+    if reply.get("status") == "ok" and reply.get("delay") is not None:
+        lineprint("Recording started by daemon in "+str(reply["delay"])+"s..")
+    elif reply.get("status") != "ok":
+        lineprint("Daemon could not record: "+str(reply.get("message"))+"..")
+
+    return reply
+
+
+def dmn():
+
+    """To run the recorder daemon from the command line"""
+
+    parser = argparse.ArgumentParser(prog="recdaemon",
+             description=RecDaemon.__doc__,
+             formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument("-c","--configfile", default="pirecorder.conf", metavar="")
+    parser.add_argument("-s","--socketfile", default=None, metavar="")
+    parser.add_argument("-p","--timeplan", default=None, metavar="")
+
+    args = parser.parse_args()
+    if not isrpi():
+        lineprint("PiRecorder only works on a raspberry pi. Exiting..")
+        return
+    RecDaemon(configfile = args.configfile, socketfile = args.socketfile,
+              timeplan = args.timeplan).run()
@@ -0,0 +1,362 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2020 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import struct
+import tempfile
+import subprocess
+import numpy as np
+
+from time import monotonic, sleep
+from collections import namedtuple
+from pythutils.sysutils import lineprint
+
+FRAMETYPE = np.dtype([("index","<u4"), ("pts","<i8"), ("key","u1"),
+                      ("size","<u4")])
+
+# Frame types of picamera's PiVideoFrameType
+KEYFRAME = 1
+SKIPTYPES = (2, 3)
+
+VideoFrame = namedtuple("VideoFrame", ["index", "frame_type", "frame_size",
+                                       "timestamp", "complete"])
+
+class Mp4Output:
+
+    """
+    File-like output that streams a raw H.264 elementary stream into an MP4
+    container while recording, by piping it to a single ffmpeg process that
+    copies the video without re-encoding. The MP4 is written as fragments so
+    that it stays playable up to the last keyframe if the recording is cut
+    off, and is complete as soon as the output is closed, which removes the
+    need for a separate Convert pass. So that footage is never lost, the
+    stream is written to a raw .h264 file instead when ffmpeg can not be
+    started, or from the moment ffmpeg stops, in which case filename is set
+    to the .h264 file.
+
+    Parameters
+    ----------
+    filename : str
+        The MP4 file to write the video to.
+    fps : float
+        The framerate of the video, used for the timestamps in the container.
+    """
+
+    def __init__(self, filename, fps):
+
+        self.filename = filename
+        self.raw = None
+        self.closed = False
+        comm = ["ffmpeg", "-loglevel", "error", "-y", "-f", "h264",
+                "-framerate", str(fps), "-i", "-", "-c", "copy",
+                "-movflags", "frag_keyframe+empty_moov", filename]
+        self.errors = tempfile.TemporaryFile()
+        try:
+            self.proc = subprocess.Popen(comm, stdin = subprocess.PIPE,
+                                         stdout = subprocess.DEVNULL,
+                                         stderr = self.errors)
+        except OSError as e:
+            self.proc = None
+            self._fallback("could not start ffmpeg (%s)" % e)
+
+
+    def _fallback(self, error):
+
+        """Continues writing the stream to a raw .h264 file"""
+
+        rawname = os.path.splitext(self.filename)[0]+".h264"
+        if os.path.exists(rawname):
+            rawname = self.filename+".h264"
+        if self.proc is not None:
+            self.errors.seek(0)
+            lines = self.errors.read().decode(errors = "replace").strip()
+            error = lines.split("\n")[-1] or error
+        lineprint("Writing "+self.filename+" failed: "+error+", continuing "+\
+                  "in "+rawname+"..")
+        self.raw = open(rawname, "wb")
+        self.filename = rawname
+
+
+    def write(self, buf):
+
+        if self.raw is None and self.proc.poll() is not None:
+            self._fallback("ffmpeg exited with "+str(self.proc.returncode))
+        if self.raw is not None:
+            return self.raw.write(buf)
+        try:
+            self.proc.stdin.write(buf)
+        except OSError as e:
+            self._fallback("ffmpeg stopped (%s)" % e)
+            self.raw.write(buf)
+
+        return len(buf)
+
+
+    def flush(self):
+
+        if self.raw is not None:
+            return self.raw.flush()
+        try:
+            self.proc.stdin.flush()
+        except OSError as e:
+            self._fallback("ffmpeg stopped (%s)" % e)
+
+
+    def close(self):
+
+        """Closes the pipe and waits until ffmpeg has finalised the file"""
+
+        if self.closed:
+            return
+        self.closed = True
+        if self.raw is not None:
+            self.raw.close()
+        if self.proc is not None:
+            try:
+                self.proc.stdin.close()
+            except OSError:
+                pass
+            self.proc.wait()
+            if self.proc.returncode != 0 and self.raw is None:
+                self.errors.seek(0)
+                error = self.errors.read().decode(errors = "replace").strip()
+                lineprint("Writing "+self.filename+" failed: "+\
+                          (error.split("\n")[-1] or "ffmpeg exited with "+\
+                           str(self.proc.returncode)))
+        self.errors.close()
+
+
+def mediafile(filename, fps = None):
+
+    """Opens filename for writing encoded video, streaming into an MP4
+    container with Mp4Output if it has an .mp4 extension"""
+
+    if filename.endswith(".mp4"):
+        return Mp4Output(filename, fps)
+
+    return open(filename, "wb")
+
+
+class FrameOutput:
+
+    """
+    File-like output for the camera's video encoder that writes the encoded
+    video to a file and keeps track of the frames it receives, using the
+    camera's frame information that is updated for each encoder buffer.
+    Frames are counted as dropped when the gap between subsequent timestamps
+    is more than 1.5 frame intervals. Each gap is stored with the encoder's
+    frame index and timestamp at which it occurred, so that gaps can be
+    reported while recording. The time spent writing is summed.
+
+    Parameters
+    ----------
+    camera : picamera.PiCamera
+        The camera that is recording to this output.
+    filename : str
+        The file to write the video to. Files with an .mp4 extension are
+        written as MP4 with Mp4Output.
+    sidecar : str, default = None
+        Optional file to which the index, presentation timestamp (in
+        microseconds), keyframe flag and encoded size of each frame are
+        written as compact binary records, which can be read with readframes().
+    """
+
+    def __init__(self, camera, filename, sidecar = None):
+
+        self.camera = camera
+        self.filename = filename
+        self.fps = float(camera.framerate)
+        self.file = mediafile(filename, self.fps)
+        self.sidecar = None if sidecar is None else open(sidecar, "wb")
+
+        self.frames = 0
+        self.first = None
+        self.last = None
+        self.start = None
+        self.end = None
+        self.dropped = 0
+        self.gaps = []
+        self.reported = 0
+        self.bytes = 0
+        self.writetime = 0.
+
+
+    def write(self, buf):
+
+        frame = self.camera.frame
+        if frame is not None and frame.complete and \
+           frame.frame_type not in SKIPTYPES:
+            self.frames += 1
+            if self.first is None:
+                self.first = frame.index
+            self.last = frame.index
+            if frame.timestamp is not None:
+                if self.start is None:
+                    self.start = frame.timestamp
+                elif self.fps > 0:
+                    gap = (frame.timestamp - self.end) * self.fps / 1000000.
+                    if gap > 1.5:
+                        missing = int(round(gap)) - 1
+                        self.dropped += missing
+                        self.gaps.append((frame.index, frame.timestamp,
+                                          missing, frame.timestamp - self.end))
+                self.end = frame.timestamp
+            if self.sidecar is not None:
+                pts = -1 if frame.timestamp is None else frame.timestamp
+                self.sidecar.write(struct.pack("<IqBI", frame.index, pts,
+                                   frame.frame_type == KEYFRAME,
+                                   frame.frame_size))
+
+        start = monotonic()
+        written = self.file.write(buf)
+        self.writetime += monotonic() - start
+        self.bytes += len(buf)
+
+        return written
+
+
+    def flush(self):
+
+        self.file.flush()
+
+
+    def duration(self):
+
+        """Returns the time in seconds between the first and last frame"""
+
+        if self.start is None:
+            return 0.
+        return (self.end - self.start) / 1000000.
+
+
+    def newgaps(self):
+
+        """Returns the gaps that occurred since the last call as a list of
+        (frame index, timestamp, frames missing, gap in microseconds)"""
+
+        gaps = self.gaps[self.reported:]
+        self.reported += len(gaps)
+
+        return gaps
+
+
+    def dropfraction(self):
+
+        """Returns the fraction of the expected frames that was dropped"""
+
+        expected = self.frames + self.dropped
+
+        return self.dropped / float(expected) if expected else 0.
+
+
+    def summary(self):
+
+        """Returns a summary of the frames and gaps of the output"""
+
+        text = str(self.frames)+" frames"
+        if self.gaps:
+            text += ", "+str(self.dropped)+" dropped ("+\
+                    str(round(self.dropfraction()*100, 2))+"%) in "+\
+                    str(len(self.gaps))+" gaps, largest "+\
+                    str(round(max(g[3] for g in self.gaps)/1000.))+"ms"
+        else:
+            text += ", none dropped"
+
+        return text
+
+
+    def close(self):
+
+        self.file.close()
+        self.filename = getattr(self.file, "filename", self.filename)
+        if self.sidecar is not None:
+            self.sidecar.close()
+
+
+class SyntheticFrames:
+
+    """
+    Stand-in for the camera that feeds a stream of fake encoded frames with
+    injected gaps to a FrameOutput, with the same frame information as the
+    camera provides, to test dropped-frame detection without a camera
+
+    Parameters
+    ----------
+    fps : float, default = 24
+        The framerate of the stream.
+    gaps : dict, default = None
+        The number of frames to drop (value) before each frame nr (key).
+    realtime : bool, default = False
+        If frames should be fed at the framerate instead of at once.
+    """
+
+    def __init__(self, fps = 24, gaps = None, realtime = False):
+
+        self.framerate = fps
+        self.gaps = gaps or {}
+        self.realtime = realtime
+        self.frame = None
+
+
+    def play(self, output, nrframes, framesize = 1000):
+
+        """Feeds nrframes frames to output, skipping the injected gaps"""
+
+        interval = 1000000. / self.framerate
+        start = monotonic()
+        pts = 0
+        for nr in range(nrframes):
+            pts += self.gaps.get(nr, 0)
+            ftype = KEYFRAME if nr % int(self.framerate) == 0 else 0
+            self.frame = VideoFrame(nr, ftype, framesize,
+                                    int(round(pts * interval)), True)
+            output.write(b"\x00" * framesize)
+            pts += 1
+            if self.realtime:
+                sleep(max(0, start + pts * interval / 1000000. - monotonic()))
+
+
+def readframes(filename):
+
+    """Reads a frame sidecar file as a numpy record array with the fields
+    index, pts (microseconds, -1 if unknown), key and size"""
+
+    return np.fromfile(filename, dtype=FRAMETYPE)
+
+
+def framestats(frames, fps = None):
+
+    """
+    Summarises the frames of a sidecar file, returning the number of frames,
+    the framerate estimated from the presentation timestamps, and the number
+    of dropped frames (gaps of more than 1.5 frame intervals) and duplicated
+    frames (repeated timestamps)
+    """
+
+    pts = frames["pts"][frames["pts"] >= 0] / 1000000.
+    deltas = np.diff(pts)
+    if fps is None:
+        median = np.median(deltas) if len(deltas) > 0 else 0
+        fps = 1. / median if median > 0 else 0.
+    dropped = 0
+    if fps > 0:
+        gaps = deltas[deltas > 1.5 / fps]
+        dropped = int(np.sum(np.round(gaps * fps) - 1))
+    duplicated = int(np.sum(deltas == 0))
+
+    return {"frames": len(frames), "fps": round(float(fps), 3),
+            "dropped": dropped, "duplicated": duplicated}
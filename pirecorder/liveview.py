@@ -0,0 +1,254 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2020 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import cv2
+import socket
+import numpy as np
+
+from time import monotonic, sleep
+from threading import Thread, Condition
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pythutils.sysutils import lineprint
+
+PAGE = b"""<html><head><title>pirecorder live view</title></head>
+<body style="margin:0;background:#000"><img src="/stream.mjpg"
+style="display:block;margin:auto;max-width:100%;max-height:100vh"></body></html>
+"""
+
+class SyntheticSource:
+
+    """
+    Frame source that generates a moving test pattern of BGR frames at a fixed
+    framerate, with the same interface as the recorder's preview output, to
+    test the live-view server without a camera
+
+    Parameters
+    ----------
+    resolution : tuple, default = (320, 240)
+        The resolution of the frames.
+    fps : float, default = 24
+        The number of frames generated per second.
+    """
+
+    def __init__(self, resolution = (320, 240), fps = 24):
+
+        self.resolution = tuple(resolution)
+        self.fps = fps
+        self.frame = None
+        self.count = 0
+        self.stopped = False
+        self.condition = Condition()
+        Thread(target = self._generate, daemon = True).start()
+
+
+    def _generate(self):
+
+        width, height = self.resolution
+        gradient = np.tile(np.linspace(0, 255, width, dtype=np.uint8), (height, 1))
+        start = monotonic()
+        while not self.stopped:
+            frame = np.dstack([gradient, np.roll(gradient, self.count*4, axis=1),
+                               np.full_like(gradient, self.count % 256)])
+            with self.condition:
+                self.frame = frame
+                self.count += 1
+                self.condition.notify_all()
+            sleep(max(0, start + self.count / float(self.fps) - monotonic()))
+
+
+    def read(self):
+
+        with self.condition:
+            return self.frame
+
+
+    def wait(self, count = 0, timeout = 1):
+
+        with self.condition:
+            self.condition.wait_for(lambda: self.count > count, timeout)
+            return self.frame, self.count
+
+
+    def close(self):
+
+        self.stopped = True
+
+
+class LiveView:
+
+    """
+    Lightweight HTTP server that serves live MJPEG video (/stream.mjpg) and
+    single snapshots (/snapshot.jpg) of the frames of a running recording,
+    to check headless raspberry pis from a browser. Raw frames are encoded to
+    jpeg by a single encoder thread, separate from the capture, and only while
+    someone is watching. Each client is sent the most recent frame when it is
+    ready for it, so frames are dropped for slow clients instead of buffered.
+
+    Parameters
+    ----------
+    source : object
+        The frame source with a wait(count, timeout) method that returns the
+        most recent frame and its count, such as the recorder's preview. Frames
+        can be BGR numpy arrays or jpeg-encoded bytes.
+    port : int, default = 8000
+        The port the server listens on.
+    host : str, default = ""
+        The address the server listens on, all addresses by default.
+    quality : int, default = 75
+        The jpeg quality of encoded raw frames.
+
+    Example
+    -------
+    >>> view = LiveView(SyntheticSource(), port = 8000).start()
+    and open http://<raspberry pi address>:8000 in a browser.
+    """
+
+    def __init__(self, source, port = 8000, host = "", quality = 75):
+
+        self.source = source
+        self.port = port
+        self.host = host
+        self.quality = int(quality)
+
+        self.jpeg = None
+        self.count = 0
+        self.viewers = 0
+        self.stopped = False
+        self.condition = Condition()
+        self.server = None
+
+
+    def _encode(self):
+
+        """Encodes the most recent source frame whenever someone is watching"""
+
+        count = 0
+        while not self.stopped:
+            with self.condition:
+                self.condition.wait_for(lambda: self.viewers > 0 or self.stopped)
+            if self.stopped:
+                break
+            frame, count = self.source.wait(count, timeout = 0.5)
+            if frame is None:
+                continue
+            if isinstance(frame, np.ndarray):
+                ok, jpeg = cv2.imencode(".jpg", frame,
+                                        [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+                if not ok:
+                    continue
+                frame = jpeg.tobytes()
+            with self.condition:
+                self.jpeg = frame
+                self.count += 1
+                self.condition.notify_all()
+
+
+    def frame(self, count = 0, timeout = 2):
+
+        """Returns the next jpeg frame newer than count and its count"""
+
+        with self.condition:
+            self.viewers += 1
+            self.condition.notify_all()
+            try:
+                self.condition.wait_for(lambda: self.count > count or \
+                                        self.stopped, timeout)
+                return self.jpeg, self.count
+            finally:
+                self.viewers -= 1
+
+
+    def _handler(self):
+
+        view = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, content, ctype):
+                self.send_response(200)
+                self.send_header("Content-Type", ctype)
+                self.send_header("Content-Length", str(len(content)))
+                self.send_header("Cache-Control", "no-cache, private")
+                self.end_headers()
+                self.wfile.write(content)
+
+            def do_GET(self):
+                if self.path in ["/", "/index.html"]:
+                    self._send(PAGE, "text/html")
+                elif self.path == "/snapshot.jpg":
+                    jpeg, _ = view.frame()
+                    if jpeg is None:
+                        self.send_error(503, "No frames available")
+                    else:
+                        self._send(jpeg, "image/jpeg")
+                elif self.path == "/stream.mjpg":
+                    self.send_response(200)
+                    self.send_header("Age", "0")
+                    self.send_header("Cache-Control", "no-cache, private")
+                    self.send_header("Pragma", "no-cache")
+                    self.send_header("Content-Type",
+                                     "multipart/x-mixed-replace; boundary=FRAME")
+                    self.end_headers()
+                    count = 0
+                    try:
+                        while not view.stopped:
+                            jpeg, newcount = view.frame(count)
+                            if jpeg is None or newcount == count:
+                                continue
+                            count = newcount
+                            self.wfile.write(b"--FRAME\r\n")
+                            self.wfile.write(b"Content-Type: image/jpeg\r\n")
+                            self.wfile.write(b"Content-Length: %d\r\n\r\n" % len(jpeg))
+                            self.wfile.write(jpeg)
+                            self.wfile.write(b"\r\n")
+                    except (BrokenPipeError, ConnectionResetError, socket.error):
+                        pass
+                else:
+                    self.send_error(404)
+
+        return Handler
+
+
+    def start(self):
+
+        """Starts the server and encoder in background threads"""
+
+        self.stopped = False
+        self.server = ThreadingHTTPServer((self.host, self.port), self._handler())
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        Thread(target = self._encode, daemon = True).start()
+        Thread(target = self.server.serve_forever, daemon = True).start()
+        lineprint("Live view available at port "+str(self.port)+"..")
+
+        return self
+
+
+    def stop(self):
+
+        """Stops the server"""
+
+        self.stopped = True
+        with self.condition:
+            self.condition.notify_all()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
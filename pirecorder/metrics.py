@@ -0,0 +1,172 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2020 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import json
+import resource
+
+from time import monotonic
+from datetime import datetime
+
+from .config import _atomicwrite
+
+PROMETHEUS = [("warmup", "warmup_seconds", "Camera warm-up time"),
+              ("elapsed", "duration_seconds", "Duration of the recording"),
+              ("files", "files", "Number of files recorded"),
+              ("frames", "frames", "Number of frames captured"),
+              ("expected", "frames_expected", "Number of frames expected"),
+              ("dropped", "frames_dropped", "Number of frames dropped"),
+              ("gaps", "frame_gaps", "Number of gaps of dropped frames"),
+              ("bytes", "bytes", "Number of bytes written"),
+              ("bitrate", "bitrate_bps", "Mean bitrate of the recording"),
+              ("write_max", "write_seconds_max", "Longest file write time"),
+              ("cpu", "cpu_seconds", "Process cpu time during the recording"),
+              ("cpu_children", "cpu_children_seconds",
+               "Cpu time of child processes such as ffmpeg"),
+              ("maxrss", "max_rss_bytes", "Peak resident memory of the process"),
+              ("finished", "finished_timestamp_seconds",
+               "Unix time at which the recording finished")]
+
+def _cputime(usage):
+
+    return usage.ru_utime + usage.ru_stime
+
+
+class Metrics:
+
+    """
+    Collects the performance metrics of a single recording, such as the
+    warm-up time, the frames captured, expected and dropped, the bitrate and
+    write time per file, and the cpu time and peak memory of the process.
+    Values are collected from counters the outputs already keep, so that the
+    collection itself adds no work per frame.
+
+    Parameters
+    ----------
+    rectype : str
+        The type of recording.
+    label : str, default = ""
+        The label of the recording.
+    host : str, default = ""
+        The name of the raspberry pi.
+    """
+
+    def __init__(self, rectype, label = "", host = ""):
+
+        self.values = {"rectype": rectype, "label": label, "host": host,
+                       "started": datetime.now().isoformat(), "warmup": 0.}
+        self.files = []
+        self.paths = []
+        self.start = monotonic()
+        self.usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+
+    def set(self, **kwargs):
+
+        """Stores recording-wide values"""
+
+        self.values.update(kwargs)
+
+
+    def addfile(self, filename, frames = None, expected = None, dropped = None,
+                duration = None, writetime = None, gaps = None):
+
+        """Stores the metrics of a recorded file, with the bitrate calculated
+        from its size and duration"""
+
+        size = os.path.getsize(filename) if os.path.isfile(filename) else 0
+        entry = {"file": os.path.basename(filename), "bytes": size,
+                 "frames": frames, "expected": expected, "dropped": dropped,
+                 "gaps": gaps,
+                 "duration": None if duration is None else round(duration, 3),
+                 "bitrate": None, "writetime": None}
+        if duration:
+            entry["bitrate"] = int(size * 8 / duration)
+        if writetime is not None:
+            entry["writetime"] = round(writetime, 4)
+        self.files.append(entry)
+        self.paths.append(filename)
+
+
+    def finish(self):
+
+        """Adds the totals of all files and the resource usage of the
+        recording and returns all metrics"""
+
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        elapsed = monotonic() - self.start
+
+        def total(key):
+            vals = [f[key] for f in self.files if f[key] is not None]
+            return sum(vals) if vals else self.values.get(key)
+
+        self.values.update({"files": len(self.files),
+                            "frames": total("frames"),
+                            "expected": total("expected"),
+                            "dropped": total("dropped"),
+                            "gaps": total("gaps"),
+                            "bytes": total("bytes"),
+                            "elapsed": round(elapsed, 3)})
+        durations = [f["duration"] for f in self.files if f["duration"]]
+        if durations:
+            self.values["bitrate"] = int(self.values["bytes"]*8/sum(durations))
+        writes = [f["writetime"] for f in self.files if f["writetime"] is not None]
+        if writes:
+            self.values["write_max"] = max(writes)
+        cpu = _cputime(usage) - _cputime(self.usage)
+        self.values.update({"cpu": round(cpu, 3),
+                            "cpu_percent": round(100.*cpu/max(elapsed,1e-6), 1),
+                            "cpu_children": round(_cputime(children) - \
+                                                  _cputime(self.children), 3),
+                            "maxrss": usage.ru_maxrss * 1024,
+                            "finished": round(datetime.now().timestamp(), 3)})
+
+        return dict(self.values, filemetrics = self.files)
+
+
+    def prometheus(self):
+
+        """Returns the metrics in the Prometheus text exposition format"""
+
+        labels = ",".join('%s="%s"' % (key, str(self.values[key]).replace('"',''))
+                          for key in ["host", "label", "rectype"])
+        lines = []
+        for key, metric, text in PROMETHEUS:
+            value = self.values.get(key)
+            if value is None:
+                continue
+            lines.append("# HELP pirecorder_%s %s" % (metric, text))
+            lines.append("# TYPE pirecorder_%s gauge" % metric)
+            lines.append("pirecorder_%s{%s} %s" % (metric, labels, value))
+
+        return "\n".join(lines)+"\n"
+
+
+    def save(self, jsonfile, promfile = None):
+
+        """Finishes the metrics and writes them as json to jsonfile and
+        optionally as a Prometheus textfile for node_exporter to promfile"""
+
+        metrics = self.finish()
+        with open(jsonfile, "w") as f:
+            json.dump(metrics, f, indent = 2)
+        if promfile:
+            _atomicwrite(promfile, self.prometheus())
+
+        return metrics
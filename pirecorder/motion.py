@@ -0,0 +1,244 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2020 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import numpy as np
+
+from io import BytesIO
+from time import monotonic
+from threading import Lock
+
+from .frames import mediafile
+
+MVTYPE = np.dtype([("x","i1"), ("y","i1"), ("sad","u2")])
+SERIESTYPE = np.dtype([("frame","<u4"), ("time","<f8"), ("activity","<f4"),
+                       ("magnitude","<f4")])
+
+class FrameDiff:
+
+    """
+    Simple motion detector that compares subsequent low-resolution grayscale
+    frames and computes the fraction of pixels that changed
+
+    Parameters
+    ----------
+    threshold : float, default = 0.01
+        The fraction of pixels that need to have changed to detect motion.
+    pixdiff : int, default = 25
+        The minimum difference in grayscale value for a pixel to have changed.
+    """
+
+    def __init__(self, threshold = 0.01, pixdiff = 25):
+
+        self.threshold = threshold
+        self.pixdiff = pixdiff
+        self.previous = None
+
+
+    def update(self, gray):
+
+        """Returns the activity of a new frame and if it contains motion"""
+
+        gray = gray.astype(np.int16)
+        if self.previous is None:
+            self.previous = gray
+            return 0., False
+        activity = float(np.mean(np.abs(gray - self.previous) > self.pixdiff))
+        self.previous = gray
+
+        return activity, activity > self.threshold
+
+
+class TriggerOutput:
+
+    """
+    File output for the video encoder that holds all encoded video in memory
+    until the pre-trigger video has been written to the file with release(),
+    so that the pre-trigger and post-trigger video end up in a single file
+
+    Parameters
+    ----------
+    filename : str
+        The file to write the video to.
+    fps : float, default = None
+        The framerate of the video, needed when writing to an .mp4 file.
+    """
+
+    def __init__(self, filename, fps = None):
+
+        self.filename = filename
+        self.file = mediafile(filename, fps)
+        self.held = BytesIO()
+        self.holding = True
+        self.lock = Lock()
+
+
+    def write(self, buf):
+
+        with self.lock:
+            if self.holding:
+                return self.held.write(buf)
+            return self.file.write(buf)
+
+
+    def release(self):
+
+        """Writes the held video to the file and continues writing directly"""
+
+        with self.lock:
+            self.file.write(self.held.getvalue())
+            self.held = None
+            self.holding = False
+
+
+    def flush(self):
+
+        self.file.flush()
+
+
+    def close(self):
+
+        if self.holding:
+            self.release()
+        self.file.close()
+        self.filename = getattr(self.file, "filename", self.filename)
+
+
+class MotionVectors:
+
+    """
+    Motion output for the video encoder that computes the activity of each
+    frame from the encoder's macroblock motion vectors, without decoding
+    any frames. Activity is the fraction of macroblocks that moved more than
+    a threshold, and is written with the mean motion vector
+    magnitude as a compact binary time series that can be read with
+    readmotion().
+
+    Parameters
+    ----------
+    resolution : tuple
+        The resolution of the encoded video.
+    filename : str, default = None
+        The file to write the activity time series to.
+    camera : picamera.PiCamera, default = None
+        The recording camera, used to get the timestamp of each frame. If not
+        provided the time since the first frame is used.
+    threshold : float, default = 2
+        The minimum motion vector magnitude in pixels for a macroblock to
+        count as moving.
+    """
+
+    def __init__(self, resolution, filename = None, camera = None,
+                 threshold = 2):
+
+        self.cols = (resolution[0] + 15) // 16 + 1
+        self.rows = (resolution[1] + 15) // 16
+        self.size = self.rows * self.cols * MVTYPE.itemsize
+        self.camera = camera
+        self.threshold2 = threshold ** 2
+        self.file = None if filename is None else open(filename, "wb")
+        self.nrblocks = self.rows * (self.cols - 1)
+
+        self.frames = 0
+        self.start = None
+        self.activity = 0.
+        self.peakactivity = 0.
+        self.buf = b""
+
+
+    def write(self, buf):
+
+        data = self.buf + bytes(buf) if self.buf else buf
+        nr = len(data) // self.size
+        if nr > 0:
+            vectors = np.frombuffer(data, dtype=MVTYPE, count=nr*self.size//MVTYPE.itemsize)
+            for a in vectors.reshape(nr, self.rows, self.cols):
+                self.analyse(a)
+        self.buf = bytes(data[nr*self.size:])
+
+        return len(buf)
+
+
+    def analyse(self, a):
+
+        """Computes and stores the activity of a single frame of vectors"""
+
+        # The last column of macroblocks is padding without motion data
+        x = a["x"][:, :-1].astype(np.int16)
+        y = a["y"][:, :-1].astype(np.int16)
+        mag2 = x*x + y*y
+        self.activity = np.count_nonzero(mag2 > self.threshold2) / float(self.nrblocks)
+        self.peakactivity = max(self.peakactivity, self.activity)
+
+        frame = self.camera.frame if self.camera is not None else None
+        if frame is not None and frame.timestamp is not None:
+            now = frame.timestamp / 1000000.
+        else:
+            now = monotonic()
+        if self.start is None:
+            self.start = now
+        if self.file is not None:
+            record = np.array([(self.frames, now - self.start, self.activity,
+                                np.sqrt(mag2).mean())], dtype=SERIESTYPE)
+            self.file.write(record.tobytes())
+        self.frames += 1
+
+
+    def peak(self):
+
+        """Returns the highest activity since the last call and resets it"""
+
+        peak, self.peakactivity = self.peakactivity, 0.
+
+        return peak
+
+
+    def flush(self):
+
+        if self.file is not None:
+            self.file.flush()
+
+
+    def close(self):
+
+        if self.file is not None:
+            self.file.close()
+
+
+def readmotion(filename):
+
+    """Reads a motion activity time series as a numpy record array with the
+    fields frame, time (s), activity and magnitude"""
+
+    return np.fromfile(filename, dtype=SERIESTYPE)
+
+
+def motionseries(datafile, resolution, filename, threshold = 2):
+
+    """Computes the motion activity time series offline from a file of raw
+    motion vectors as recorded with picamera's motion_output, writes it to
+    filename and returns it"""
+
+    vectors = MotionVectors(resolution, filename, threshold = threshold)
+    with open(datafile, "rb") as f:
+        while True:
+            data = f.read(vectors.size * 64)
+            if not data:
+                break
+            vectors.write(data)
+    vectors.close()
+
+    return readmotion(filename)
@@ -0,0 +1,332 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2020 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import sys
+import json
+import fcntl
+import hashlib
+import threading
+import subprocess
+
+from contextlib import contextmanager
+
+from time import monotonic, sleep
+from pythutils.sysutils import lineprint
+
+from .config import _atomicwrite
+
+def listfiles(directory):
+
+    """Returns the set of paths of all files in directory and its
+    subdirectories, relative to directory"""
+
+    files = set()
+    for root, _, names in os.walk(directory):
+        for name in names:
+            files.add(os.path.relpath(os.path.join(root, name), directory))
+
+    return files
+
+
+def checksum(filename, chunksize = 1000000):
+
+    """Returns the sha256 checksum of a file"""
+
+    sha = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(chunksize), b""):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+
+class Offload:
+
+    """
+    Background transfer queue that moves finished recordings from local
+    storage to a target directory, such as a mounted NAS, so that recording
+    never depends on the network. Files are copied in chunks to a ".part" file
+    with an optional bandwidth limit so that the transfer does not compete
+    with a running recording, the copy is read back and verified against the
+    checksum of the local file, and only then renamed to its final name and
+    the local file deleted. Queued files are stored in a journal, so that
+    transfers that were interrupted, e.g. by a reboot or because the process
+    ended, are resumed from the partial copy when the queue is next started.
+    Multiple processes can share the same journal: it is only changed while
+    it is locked, and each file is claimed with a lock before it is copied.
+
+    Parameters
+    ----------
+    target : str
+        The directory to move the files to.
+    journal : str
+        The json file in which queued transfers are stored.
+    ratelimit : float, default = 0
+        The maximum transfer rate in bytes per second, 0 for no limit.
+    chunksize : int, default = 1000000
+        The number of bytes copied at a time.
+    attempts : int, default = 3
+        The number of times a file is copied before giving up until the queue
+        is next started, e.g. when verification keeps failing.
+    start : bool, default = True
+        If files should be transferred by a background thread of this process.
+        If False files are only queued in the journal, e.g. to be transferred
+        by a detached process started with detach().
+    """
+
+    def __init__(self, target, journal, ratelimit = 0, chunksize = 1000000,
+                 attempts = 3, start = True):
+
+        self.target = target
+        self.journalfile = journal
+        self.lockdir = os.path.join(os.path.dirname(os.path.abspath(journal)),
+                                    ".offload_locks")
+        os.makedirs(self.lockdir, exist_ok = True)
+        self.ratelimit = ratelimit
+        self.chunksize = chunksize
+        self.attempts = attempts
+        self.start = start
+
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopped = False
+        self.failed = {}
+        self.claimed = set()
+        self.moved = 0
+        self.nrbytes = 0
+
+        self.journal = self._update()
+        if self.journal and self.start:
+            lineprint("Resuming offload of "+str(len(self.journal))+" files..")
+            self._start()
+
+
+    @contextmanager
+    def _locked(self):
+
+        """Locks the journal against changes by other processes"""
+
+        with open(self.journalfile+".lock", "w") as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+    def _update(self, add = None, remove = None):
+
+        """Merges the provided changes into the journal on disk while it is
+        locked and returns the resulting journal"""
+
+        with self.lock, self._locked():
+            journal = {}
+            if os.path.isfile(self.journalfile):
+                with open(self.journalfile) as f:
+                    journal = json.load(f)
+            if add or remove:
+                journal.update(add or {})
+                for src in remove or []:
+                    journal.pop(src, None)
+                _atomicwrite(self.journalfile, json.dumps(journal, indent = 1))
+            self.journal = journal
+
+        return journal
+
+
+    def add(self, filename, directory):
+
+        """Queues filename, relative to directory, to be moved to the same
+        relative location in the target directory"""
+
+        src = os.path.abspath(os.path.join(directory, filename))
+        self._update(add = {src: os.path.join(self.target, filename)})
+        if self.start:
+            self._start()
+
+
+    def _start(self):
+
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.stopped = False
+                self.thread = threading.Thread(target = self._run, daemon = True)
+                self.thread.start()
+
+
+    def _claim(self, src):
+
+        """Returns an open lock file if src could be claimed for copying by
+        this process, or None if another process is copying it"""
+
+        name = hashlib.sha1(src.encode()).hexdigest()+".lock"
+        lockfile = open(os.path.join(self.lockdir, name), "w")
+        try:
+            fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (BlockingIOError, PermissionError):
+            lockfile.close()
+            return None
+
+        return lockfile
+
+
+    def _next(self):
+
+        """Returns the next file in the journal that is not being copied by
+        another process, claimed, and its destination"""
+
+        for src, dst in self._update().items():
+            if self.failed.get(src, 0) >= self.attempts or src in self.claimed:
+                continue
+            lockfile = self._claim(src)
+            if lockfile is None:
+                self.claimed.add(src)
+                continue
+            if src in self._update():
+                return src, dst, lockfile
+            lockfile.close()
+
+        return None, None, None
+
+
+    def _run(self):
+
+        while not self.stopped:
+            src, dst, lockfile = self._next()
+            if src is None:
+                break
+            if not os.path.isdir(self.target):
+                lineprint("Offload target "+self.target+" not available, "+\
+                          "keeping "+str(len(self.journal))+" files locally..")
+                lockfile.close()
+                break
+            try:
+                if os.path.isfile(src):
+                    self._move(src, dst)
+                else:
+                    lineprint("Offload file "+src+" no longer exists..")
+                    self._done(src)
+            except Exception as e:
+                self.failed[src] = self.failed.get(src, 0) + 1
+                lineprint("Offloading "+src+" failed: %r.." % (e,))
+            finally:
+                if src not in self.journal:
+                    os.remove(lockfile.name)
+                lockfile.close()
+
+
+    def _move(self, src, dst):
+
+        """Copies src to dst, resuming a partial copy, verifies it and
+        deletes src"""
+
+        os.makedirs(os.path.dirname(dst), exist_ok = True)
+        part = dst+".part"
+        sha = hashlib.sha256()
+        offset = os.path.getsize(part) if os.path.isfile(part) else 0
+        if offset > os.path.getsize(src):
+            offset = 0
+
+        start = monotonic()
+        with open(src, "rb") as fin, open(part, "ab" if offset else "wb") as fout:
+            fout.truncate(offset)
+            for chunk in iter(lambda: fin.read(self.chunksize), b""):
+                sha.update(chunk)
+                if fin.tell() <= offset:
+                    continue
+                if fin.tell() - len(chunk) < offset:
+                    chunk = chunk[offset - fin.tell():]
+                fout.write(chunk)
+                if self.ratelimit:
+                    sent = fin.tell() - offset
+                    sleep(max(0, start + sent / float(self.ratelimit) - monotonic()))
+                if self.stopped:
+                    return
+            fout.flush()
+            os.fsync(fout.fileno())
+        elapsed = monotonic() - start
+
+        if checksum(part, self.chunksize) != sha.hexdigest():
+            os.remove(part)
+            self.failed[src] = self.failed.get(src, 0) + 1
+            lineprint("Offload of "+src+" failed verification, retrying..")
+            return
+        os.replace(part, dst)
+        size = os.path.getsize(dst)
+        os.remove(src)
+        self._done(src)
+        self.moved += 1
+        self.nrbytes += size
+        lineprint("Offloaded "+os.path.basename(src)+" ("+\
+                  str(round(size/1e6, 2))+"MB at "+\
+                  str(round((size-offset)/max(elapsed, 1e-6)/1e6, 2))+"MB/s"+\
+                  (", resumed" if offset else "")+")..")
+
+
+    def _done(self, src):
+
+        self.failed.pop(src, None)
+        self._update(remove = [src])
+
+
+    def pending(self):
+
+        """Returns the number of files still to be moved"""
+
+        return len(self._update())
+
+
+    def wait(self, timeout = None):
+
+        """Waits until all queued files are moved or the queue stopped,
+        returning if all files were moved"""
+
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+        return not self._update()
+
+
+    def stop(self):
+
+        """Stops the transfer after the current chunk, to be resumed later
+        from the journal"""
+
+        self.stopped = True
+        if self.thread is not None:
+            self.thread.join()
+
+
+def detach(target, journal, ratelimit = 0, logfile = None):
+
+    """Starts a separate process that transfers the files queued in journal
+    and that keeps running after the calling process exits, logging to
+    logfile if provided"""
+
+    log = subprocess.DEVNULL if logfile is None else open(logfile, "a")
+    subprocess.Popen([sys.executable, "-m", "pirecorder.offload", target,
+                      journal, str(ratelimit)], stdin = subprocess.DEVNULL,
+                     stdout = log, stderr = subprocess.STDOUT,
+                     start_new_session = True)
+    if logfile is not None:
+        log.close()
+
+
+if __name__ == "__main__":
+
+    Offload(sys.argv[1], sys.argv[2], ratelimit = float(sys.argv[3])).wait()
@@ -19,26 +19,33 @@ from __future__ import print_function
 from builtins import input
 
 import os
-import cv2
 import sys
 import yaml
+import shutil
 
 import argparse
 import numpy as np
 from io import BytesIO
-from ast import literal_eval
-from datetime import datetime
+from bisect import bisect_left
 from socket import gethostname
 from fractions import Fraction
-from time import sleep, strftime
-from localconfig import LocalConfig
+from datetime import datetime
+from contextlib import contextmanager
+from time import sleep, strftime, monotonic
 from pythutils.sysutils import Logger, lineprint, homedir, checkfrac, isrpi
 from pythutils.fileutils import name
-from pythutils.mediautils import picamconv
 
-from .stream import Stream
-from .camconfig import Camconfig
-from .schedule import Schedule
+from .config import Config, validate
+from .camutils import converge, picamconv, longexposure, FrameCounter
+from .timing import DeadlineTimer, sleepuntil, waituntil, todeadline
+from .writer import WriteQueue, jpegsize
+from .frames import FrameOutput
+from .motion import FrameDiff, TriggerOutput, MotionVectors
+from .preview import PreviewOutput
+from .rawarray import RawArray
+from .storage import preflight
+from .metrics import Metrics
+from .offload import Offload, detach
 from .__version__ import __version__
 
 class PiRecorder:
@@ -93,7 +100,7 @@ class PiRecorder:
         self.configfilerel = configfile
         self.configfile = self.setupdir+"/"+configfile
 
-        self.config = LocalConfig(self.configfile, compact_form = True)
+        self.config = Config(self.configfile)
         if not os.path.isfile(self.configfile):
             lineprint("Config file "+configfile+" not found, new file created..")
             for section in ["rec","cam","cus","img","vid"]:
@@ -106,7 +113,16 @@ class PiRecorder:
                           shutterspeed=8000,imgdims=(2592,1944),maxres=None,
                           viddims=(1640,1232),imgfps=1,vidfps=24,imgwait=5.0,
                           imgnr=12,imgtime=60,imgquality=50,vidduration=10,
-                          viddelay=10,vidquality=11,automode=True,internal="")
+                          viddelay=10,vidquality=11,automode=True,
+                          warmup="fixed",overrun="skip",burst=False,
+                          writequeue=16,writepolicy="block",vidsegment=0,
+                          motionpre=5,motionpost=5,motionthresh=0.01,
+                          motionvectors=False,frametimes=True,vidformat="h264",
+                          preview=None,previewdims=(320,240),liveview=0,
+                          dropthresh=0,dropaction="alert",
+                          rawformat="gray",preflight="warn",metrics=True,
+                          promfile=None,offload=None,offloadrate=0,
+                          internal="")
             lineprint("Config settings stored..")
 
         else:
@@ -116,10 +132,7 @@ class PiRecorder:
 
         self._imgparams()
         self._shuttertofps()
-        if self.config.rec.rectype == "imgseq":
-            if self.config.cam.shutterspeed/1000000.>=(self.config.img.imgwait/5):
-                lineprint("imgwait is not enough for provided shutterspeed" + \
-                          ", will be overwritten..")
+        self._checkimgwait()
 
         if self.config.rec.recdir == "NAS":
             if not os.path.ismount(self.config.rec.recdir):
@@ -132,22 +145,24 @@ class PiRecorder:
         os.chdir(self.recdir)
 
 
-    def _setup_cam(self, auto = False, fps = None):
+    def _setup_cam(self, auto = False, fps = None, warmup = True):
 
-        """Sets up the raspberry pi camera based on the configuration"""
+        """Sets up the raspberry pi camera based on the configuration, with
+        warmup if it should wait for the camera to warm up"""
 
         import picamera
-        import picamera.array
 
         self.cam = picamera.PiCamera()
         self.cam.rotation = self.config.cus.rotation
         self.cam.exposure_compensation = self.config.cam.compensation
 
-        if self.config.rec.rectype in ["img","imgseq"]:
-            self.cam.resolution = literal_eval(self.config.img.imgdims)
+        if self.config.rec.rectype in ["img","imgseq","imgraw"]:
+            self.cam.resolution = self.config.img.imgdims
             self.cam.framerate = self.config.img.imgfps
-        if self.config.rec.rectype in ["vid","vidseq"]:
-            self.cam.resolution = picamconv(literal_eval(self.config.vid.viddims))
+            if self.config.rec.rectype in ["imgseq","imgraw"] and self.config.img.burst:
+                self.cam.framerate = min(self.cam.framerate, 15)
+        if self.config.rec.rectype in ["vid","vidseq","vidmotion"]:
+            self.cam.resolution = picamconv(self.config.vid.viddims)
             self.cam.framerate = self.config.vid.vidfps
         if fps != None:
             self.cam.framerate = fps
@@ -156,31 +171,56 @@ class PiRecorder:
             self.cam.zoom = (0,0,1,1)
             self.resize = self.cam.resolution
         else:
-            self.cam.zoom = literal_eval(self.config.cus.roi)
+            self.cam.zoom = self.config.cus.roi
             w = int(self.cam.resolution[0]*self.cam.zoom[2])
             h = int(self.cam.resolution[1]*self.cam.zoom[3])
-            if self.config.rec.rectype in ["vid","vidseq"]:
+            if self.config.rec.rectype in ["vid","vidseq","vidmotion"]:
                 self.resize = picamconv((w,h))
             else:
                 self.resize = (w,h)
 
-        self.longexpo = False if self.cam.framerate >= 6 else True
+        self.longexpo = not auto and self._longexpo()
+        if self.longexpo:
+            self._setup_longexpo()
+            return
 
         self.cam.exposure_mode = "auto"
         self.cam.awb_mode = "auto"
+        if not warmup:
+            self.cam.shutter_speed = 0
+            self.warmuptime = 0.
+            return
         lineprint("Camera warming up..")
         if auto or self.config.cam.automode:
             self.cam.shutter_speed = 0
-            sleep(2)
+            waittime = 2
         elif self.cam.framerate >= 6:
-            sleep(6) if self.cam.framerate > 1.6 else sleep(10)
+            waittime = 6 if self.cam.framerate > 1.6 else 10
+        else:
+            waittime = 2
+        if self.config.cam.warmup == "converge":
+            converged, self.warmuptime, _ = converge(self.cam, timeout = waittime)
+            state = "converged" if converged else "timed out"
+            lineprint("Camera warm-up "+state+" after "+\
+                      str(round(self.warmuptime,2))+"s..")
         else:
-            sleep(2)
-        if not auto and self.config.cam.automode == False:
+            start = monotonic()
+            sleep(waittime)
+            self.warmuptime = monotonic() - start
+            lineprint("Camera warmed up in "+str(round(self.warmuptime,2))+"s..")
+        self._recstate(fixed = not auto)
+
+
+    def _recstate(self, fixed = True):
+
+        """Applies the image settings of the configuration to the camera and,
+        if fixed and automode is off, the fixed exposure and white balance"""
+
+        if fixed and self.config.cam.automode == False:
             self.cam.shutter_speed = self.config.cam.shutterspeed
             self.cam.exposure_mode = "off"
             self.cam.awb_mode = "off"
-            self.cam.awb_gains = eval(self.config.cus.gains)
+            self.cam.awb_gains = self.config.cus.gains
             sleep(0.1)
 
         brightness = self.config.cam.brightness + self.config.cus.brighttune
@@ -190,18 +230,66 @@ class PiRecorder:
         self.cam.iso = self.config.cam.iso
         self.cam.sharpness = self.config.cam.sharpness
 
-        self.rawCapture = picamera.array.PiRGBArray(self.cam,
-                          size=self.cam.resolution)
 
+    def _longexpo(self):
+
+        """Returns if images should be captured with the long-exposure path,
+        i.e. with a fixed shutterspeed longer than 1/6th of a second"""
+
+        return self.config.rec.rectype in ["img","imgseq","imgraw"] and \
+               self.config.cam.automode == False and \
+               self.config.cam.shutterspeed > 1000000/6.
 
-    def _imgparams(self, mintime = 0.45):
+
+    def _setup_longexpo(self):
+
+        """
+        Sets up the camera for long exposures with a sensor mode and
+        framerate range that allow the shutterspeed, lets the gains settle for
+        a few frames instead of a fixed warm-up time, and then fixes the gains
+        and white balance. Images are then captured through the video port so
+        that the camera stays in this state for the whole recording, without
+        the mode switches of the still port
+        """
+
+        self.cam.iso = self.config.cam.iso
+        shutter = longexposure(self.cam, self.config.cam.shutterspeed)
+        if shutter < self.config.cam.shutterspeed:
+            lineprint("Shutterspeed limited to the camera maximum of "+\
+                      str(shutter/1000000.)+"s..")
+        self.cam.exposure_mode = "auto"
+        self.cam.awb_mode = "auto"
+        lineprint("Camera settling for long exposures of "+\
+                  str(shutter/1000000.)+"s..")
+        timeout = max(2, 4 * shutter / 1000000.)
+        converged, self.warmuptime, _ = converge(self.cam, timeout = timeout,
+                                                 interval = shutter/1000000./2)
+        self.cam.exposure_mode = "off"
+        self.cam.awb_mode = "off"
+        self.cam.awb_gains = self.config.cus.gains
+        lineprint("Camera gains fixed after "+str(round(self.warmuptime,2))+\
+                  "s (analog "+str(round(float(self.cam.analog_gain),2))+\
+                  ", digital "+str(round(float(self.cam.digital_gain),2))+")..")
+
+        brightness = self.config.cam.brightness + self.config.cus.brighttune
+        self.cam.brightness = brightness
+        self.cam.contrast = self.config.cam.contrast
+        self.cam.saturation = self.config.cam.saturation
+        self.cam.sharpness = self.config.cam.sharpness
+
+
+    def _imgparams(self, mintime = 0.45, burstmintime = 0.066):
 
         """
         Calculates minimum possible imgwait and imgnr based on imgtime. The
         minimum time between subsequent images is by default set to 0.45s, the
-        time it takes to take an image with max resolution.
+        time it takes to take an image with max resolution. In burst mode
+        images are taken through the video port and the minimum time is
+        0.066s, i.e. a maximum of 15 images per second.
         """
 
+        if self.config.img.burst:
+            mintime = burstmintime
         self.config.img.imgwait = max(mintime, self.config.img.imgwait)
         totimg = int(self.config.img.imgtime / self.config.img.imgwait)
         self.config.img.imgnr = min(self.config.img.imgnr, totimg)
@@ -215,6 +303,23 @@ class PiRecorder:
         self.config.img.imgfps = min(max(fps, minfps), maxfps)
 
 
+    def _checkimgwait(self):
+
+        """Warns if imgwait is too short for the shutterspeed, which in
+        long-exposure mode only needs to be longer than the shutterspeed"""
+
+        if self.config.rec.rectype not in ["imgseq","imgraw"]:
+            return
+        shutter = self.config.cam.shutterspeed/1000000.
+        if self._longexpo():
+            if shutter > self.config.img.imgwait:
+                lineprint("imgwait is shorter than the shutterspeed, images "+\
+                          "will be skipped..")
+        elif shutter >= self.config.img.imgwait/5:
+            lineprint("imgwait is not enough for provided shutterspeed" + \
+                      ", will be overwritten..")
+
+
     def _namefile(self):
 
         """
@@ -224,48 +329,708 @@ class PiRecorder:
         """
 
         imgtypes = ["img","imgseq"]
-        self.filetype = ".jpg" if self.config.rec.rectype in imgtypes else ".h264"
+        if self.config.rec.rectype in imgtypes:
+            self.filetype = ".jpg"
+        elif self.config.rec.rectype == "imgraw":
+            self.filetype = ".npy"
+        elif self.config.vid.vidformat == "mp4" and shutil.which("ffmpeg"):
+            self.filetype = ".mp4"
+        else:
+            if self.config.vid.vidformat == "mp4":
+                lineprint("ffmpeg not found, recording h264 instead of mp4..")
+            self.filetype = ".h264"
 
+        date = strftime("%y%m%d")
         if self.config.rec.rectype == "imgseq":
-            date = strftime("%y%m%d")
             counter = "im{counter:05d}" if self.config.img.imgnr>999 else "im{counter:03d}"
             time = "{timestamp:%H%M%S}"
             self.filename = "_".join([self.config.rec.label,date,self.host,counter,time])
             self.filename = self.filename+self.filetype
         else:
-            date = strftime("%y%m%d")
             self.filename = "_".join([self.config.rec.label, date, self.host])+"_"
+        self.fileprefix = "_".join([self.config.rec.label, date, self.host])+"_"
 
         if self.config.rec.subdirs:
             subdir = name("_".join([self.config.rec.label,date,self.host]))
             os.makedirs(subdir, exist_ok=True)
             self.filename = subdir+"/"+self.filename
+            self.fileprefix = subdir+"/"+self.fileprefix
+        self.filebase = self.fileprefix+strftime("%H%M%S")
+        self.stamped = False
 
 
-    def autoconfig(self):
+    def _stamp(self):
 
         """
-        Sets the shutterspeed and white balance automatically using the
-        framerate provided in the configuration file
+        Returns the current time to name a media file with. The first time it
+        is called for a recording the sidecar files, such as the metrics and
+        timing files, are named after the same time so that they match the
+        first media file
+        """
+
+        stamp = strftime("%H%M%S")
+        if not self.stamped:
+            self.filebase = self.fileprefix+stamp
+            self.stamped = True
+
+        return stamp
+
+
+    def _preflight(self):
+
+        """
+        Checks if the recording fits in recdir and if recdir can sustain the
+        write rate it needs, based on a short write benchmark that is cached
+        per storage device. Depending on the preflight setting it warns or
+        falls back to recording in the local pirecorder directory
+        """
+
+        mode = self.config.rec.preflight
+        if not mode:
+            return
+        cachefile = self.setupdir+"/storage.yml"
+        check = preflight(os.getcwd(), self.config, cachefile)
+        if check["fits"] and check["sustains"]:
+            return
+
+        if not check["fits"]:
+            lineprint("Recording of ~"+str(round(check["size"]/1e6))+\
+                      "MB may not fit in "+os.getcwd()+" ("+\
+                      str(round(check["free"]/1e6))+"MB free)..")
+        if not check["sustains"]:
+            lineprint("Recording needs ~"+str(round(check["rate"]/1e6,1))+\
+                      "MB/s but "+os.getcwd()+" writes "+\
+                      str(round(check["throughput"]/1e6,1))+"MB/s, may stall..")
+        localdir = self.setupdir+"/recordings"
+        if mode == "fallback" and os.path.abspath(localdir) != os.getcwd():
+            os.makedirs(localdir, exist_ok = True)
+            local = preflight(localdir, self.config, cachefile)
+            if local["fits"] and (local["sustains"] or not check["fits"]):
+                os.chdir(localdir)
+                lineprint("Falling back to recording in "+localdir+"..")
+
+
+    def _waitstart(self, lead = 0):
+
+        """
+        Waits until the start_at deadline of the recording, if provided. With
+        a lead time it sleeps until lead seconds before the deadline, so that
+        files can be named and opened close to the start. Without a lead time
+        it waits precisely until the deadline, after which the recording
+        should be started and _started called to measure the start error
+        """
+
+        if self.startdeadline is None:
+            return
+        if lead:
+            sleepuntil(self.startdeadline - lead)
+            return
+        late = monotonic() - self.startdeadline
+        if late > 0:
+            lineprint("Start time passed "+str(round(late,3))+"s before the "+\
+                      "camera was ready, starting directly..")
+        else:
+            waituntil(self.startdeadline)
+        self.startmark = self.startdeadline
+        self.startdeadline = None
+
+
+    def _started(self):
+
+        """Measures and logs the start error once the camera call that starts
+        the recording has returned"""
+
+        if self.startmark is None:
+            return
+        self.starterror = monotonic() - self.startmark
+        self.startmark = None
+        self.metrics.set(starterror = self.starterror)
+        lineprint("Recording started "+str(round(self.starterror*1000,3))+\
+                  "ms after the start time..")
+
+
+    def _imgseq(self):
+
+        """
+        Captures an image sequence at fixed deadlines into in-memory buffers
+        that are written to disk in the background by a write-behind queue, so
+        that storage latency does not delay the capture. In burst mode images
+        are captured through the video port for high image rates, as are long
+        exposures. The time from the start of each capture until the image is
+        on disk is reported.
+        """
+
+        burst = bool(self.config.img.burst)
+        captures = {}
+        self._stamp()
+        overrun = self.config.img.overrun or "skip"
+        timer = DeadlineTimer(self.config.img.imgwait, overrun = overrun,
+                              logfile = self.filebase+"_timing.csv")
+        dims = self.resize if self.resize is not None else self.cam.resolution
+        writer = WriteQueue(maxsize = self.config.img.writequeue or 16,
+                            policy = self.config.img.writepolicy or "block",
+                            bufsize = jpegsize(dims, self.config.img.imgquality or 85))
+
+        def outputs():
+            while timer.slot < self.config.img.imgnr:
+                timer.wait()
+                trigger = monotonic()
+                filename = self.filename.format(counter = timer.count,
+                                                timestamp = datetime.now())
+                buf = writer.get()
+                yield buf
+                captures[filename] = monotonic() - trigger
+                self._started()
+                writer.put(buf, filename)
+                delay = timer.done()
+                if burst:
+                    continue
+                elif timer.slot < self.config.img.imgnr:
+                    lineprint("Captured "+filename+", sleeping "+\
+                              str(round(delay,2))+"s..")
+                else:
+                    lineprint("Captured "+filename)
+
+        if burst:
+            lineprint("Start burst recording of "+str(self.config.img.imgnr)+\
+                      " images..")
+        self._waitstart()
+        start = monotonic()
+        self.cam.capture_sequence(outputs(), format="jpeg",
+                                  use_video_port = burst or self.longexpo,
+                                  resize = self.resize,
+                                  quality = self.config.img.imgquality)
+        elapsed = monotonic() - start
+        writes = writer.close(logfile = self.filebase+"_writes.csv")
+        stats = timer.close()
+        for filename, write, _ in writer.latencies:
+            self.metrics.addfile(filename, frames = 1, writetime = write)
+        self.metrics.set(expected = self.config.img.imgnr,
+                         dropped = stats["skipped"] + writes["dropped"] +\
+                                   writes["failed"])
+        rate = round(stats["frames"]/max(elapsed, 1e-6),2)
+        lineprint("Captured "+str(stats["frames"])+" images at "+str(rate)+\
+                  " fps, skipped "+str(stats["skipped"])+", jitter mean "+\
+                  str(stats["mean"])+"ms, p99 "+str(stats["p99"])+"ms, max "+\
+                  str(stats["max"])+"ms")
+        lineprint("Written "+str(writes["written"])+" images ("+\
+                  str(round(writes["bytes"]/elapsed/1000000.,2))+" MB/s), "+\
+                  "dropped "+str(writes["dropped"])+", spilled "+\
+                  str(writes["spilled"])+", failed "+str(writes["failed"])+\
+                  ", write time mean "+\
+                  str(writes["write_mean"])+"ms, max "+str(writes["write_max"])+"ms")
+        self._todisk(captures, writer.latencies)
+
+
+    def _todisk(self, captures, latencies):
+
+        """Reports the time from the start of each capture until the image was
+        written to disk, stored per image for long exposures"""
+
+        todisk = [(f, captures[f], latency, captures[f] + latency)
+                  for f, _, latency in latencies if f in captures]
+        if not todisk:
+            return
+        times = [t[3] for t in todisk]
+        lineprint("Capture to disk time mean "+\
+                  str(round(np.mean(times)*1000,1))+"ms, max "+\
+                  str(round(max(times)*1000,1))+"ms")
+        if not self.longexpo:
+            return
+        with open(self.filebase+"_exposures.csv", "w") as f:
+            f.write("file,capture_ms,latency_ms,todisk_ms\n")
+            for filename, capture, latency, total in todisk:
+                f.write("%s,%.3f,%.3f,%.3f\n" % (os.path.basename(filename),
+                        capture*1000., latency*1000., total*1000.))
+
+
+    def _imgraw(self):
+
+        """
+        Captures an image sequence of unencoded frames at fixed deadlines into
+        a preallocated memory-mapped .npy file, either the grayscale Y plane or
+        BGR frames, so that they can be analysed without decoding. In burst
+        mode and for long exposures frames are captured through the video port.
+        """
+
+        burst = bool(self.config.img.burst)
+        fmt = self.config.img.rawformat or "gray"
+        dims = self.resize if self.resize is not None else self.cam.resolution
+        filename = self.filename+self._stamp()+self.filetype
+        frames = RawArray(filename, self.config.img.imgnr, dims, format = fmt)
+        timer = DeadlineTimer(self.config.img.imgwait,
+                              overrun = self.config.img.overrun or "skip",
+                              logfile = self.filebase+"_timing.csv")
+
+        def outputs():
+            while timer.slot < self.config.img.imgnr:
+                timer.wait()
+                yield frames.buffer
+                frames.add()
+                self._started()
+                timer.done()
+
+        lineprint("Start recording "+str(self.config.img.imgnr)+" "+fmt+\
+                  " frames to "+filename)
+        self._waitstart()
+        start = monotonic()
+        self.cam.capture_sequence(outputs(), format = frames.capformat,
+                                  use_video_port = burst or self.longexpo,
+                                  resize = dims)
+        elapsed = max(monotonic() - start, 1e-6)
+        size = frames.close()
+        stats = timer.close()
+        self.metrics.addfile(filename, frames = frames.count,
+                             expected = self.config.img.imgnr,
+                             dropped = stats["skipped"], duration = elapsed)
+        lineprint("Captured "+str(frames.count)+" frames at "+\
+                  str(round(frames.count/elapsed,2))+" fps ("+\
+                  str(round(size/elapsed/1000000.,2))+" MB/s), skipped "+\
+                  str(stats["skipped"])+", jitter mean "+str(stats["mean"])+\
+                  "ms, max "+str(stats["max"])+"ms")
+
+
+    def _vidsegments(self):
+
+        """
+        Records video continuously for vidduration + viddelay seconds while
+        splitting it into segment files of vidsegment seconds at keyframes, so
+        that no frames are lost between segments. The frame count, first and
+        last frame index and duration of each segment are stored in a
+        "_segments.csv" manifest.
+        """
+
+        seglen = float(self.config.vid.vidsegment)
+        total = self.config.vid.vidduration + self.config.vid.viddelay
+        nrsegments = max(1, int(np.ceil(total / seglen)))
+
+        def segment(nr):
+            return self._frameoutput(self.filename+self._stamp()+\
+                                     "_S%02d" % nr+self.filetype)
+
+        outputs = [segment(1)]
+        motion = [self._motionoutput(outputs[0].filename)]
+        self._waitstart()
+        self.cam.start_recording(outputs[0], format = "h264",
+                                 resize = self.resize,
+                                 quality = self.config.vid.vidquality,
+                                 intra_period = int(self.config.vid.vidfps),
+                                 motion_output = motion[0], level = "4.2")
+        self._started()
+        self._startpreview()
+        lineprint("Start recording "+outputs[0].filename)
+        start = monotonic()
+        completed = True
+        for nr in range(2, nrsegments+1):
+            completed = self._watchframes(outputs[-1], start+(nr-1)*seglen)
+            if not completed:
+                break
+            outputs.append(segment(nr))
+            motion.append(self._motionoutput(outputs[-1].filename))
+            self.cam.request_key_frame()
+            self.cam.split_recording(outputs[-1], motion_output = motion[-1])
+            outputs[-2].close()
+            if motion[-2] is not None:
+                motion[-2].close()
+            self._filemetrics(outputs[-2])
+            lineprint("Finished segment "+outputs[-2].filename+" ("+\
+                      outputs[-2].summary()+"), recording "+outputs[-1].filename)
+        if completed:
+            self._watchframes(outputs[-1], start+total)
+        self.cam.stop_recording()
+        self._stoppreview(sum(o.frames for o in outputs)/max(monotonic()-start, 1e-6))
+        outputs[-1].close()
+        if motion[-1] is not None:
+            motion[-1].close()
+        self._filemetrics(outputs[-1])
+        lineprint("Finished recording "+outputs[-1].filename+" ("+\
+                  outputs[-1].summary()+")")
+
+        with open(self.filebase+"_segments.csv", "w") as f:
+            f.write("segment,file,frames,first,last,duration\n")
+            for nr, output in enumerate(outputs):
+                f.write("%d,%s,%d,%s,%s,%.3f\n" % (nr+1,
+                        os.path.basename(output.filename), output.frames,
+                        output.first, output.last, output.duration()))
+        lineprint("Recorded "+str(sum(o.frames for o in outputs))+\
+                  " frames in "+str(len(outputs))+" segments..")
+
+
+    def _watchframes(self, output, until, interval = 1):
+
+        """
+        Waits until the monotonic time until while monitoring the frames the
+        video output receives, logging dropped frames as they happen. Returns
+        False if the recording should be aborted because more frames were
+        dropped than dropthresh
+        """
+
+        thresh = self.config.vid.dropthresh
+        alerted = False
+        while True:
+            remaining = until - monotonic()
+            if remaining <= 0:
+                return True
+            self.cam.wait_recording(min(interval, remaining))
+            gaps = output.newgaps()
+            if gaps:
+                lineprint("Dropped "+str(sum(g[2] for g in gaps))+" frames in "+\
+                          str(len(gaps))+" gaps, last before frame "+\
+                          str(gaps[-1][0])+" of "+output.filename+"..")
+            if not thresh or output.dropfraction() <= thresh or alerted or \
+               output.frames + output.dropped < output.fps:
+                continue
+            drops = str(round(output.dropfraction()*100, 2))+"% of frames dropped"
+            if self.config.vid.dropaction == "abort":
+                lineprint("Aborting recording, "+drops+"..")
+                self.metrics.set(aborted = True)
+                return False
+            lineprint("WARNING: "+drops+" in "+output.filename+"..")
+            self.metrics.set(alerted = True)
+            alerted = True
+
+
+    def _recorded(self, directory):
+
+        """Returns the files created by the recording, relative to directory:
+        its media files, the sidecar files named after each media file, and
+        the sidecar files named after the recording"""
+
+        files = set()
+        listings = {}
+        stems = [os.path.splitext(p)[0] for p in self.metrics.paths]
+        for stem in stems + [self.filebase]:
+            folder, name = os.path.split(os.path.join(directory, stem))
+            if folder not in listings:
+                listings[folder] = sorted(os.listdir(folder)) \
+                                   if os.path.isdir(folder) else []
+            names = listings[folder]
+            for i in range(bisect_left(names, name), len(names)):
+                if not names[i].startswith(name):
+                    break
+                if names[i][len(name):len(name)+1] in ["_", "."]:
+                    files.add(os.path.relpath(os.path.join(folder, names[i]),
+                                              directory))
+
+        return sorted(files)
+
+
+    def _offload(self, directory, keepopen = False):
+
+        """
+        Queues the files created by the recording in directory to be moved
+        to the offload directory in the background. When the camera is kept
+        open the files are moved by a thread of this process, otherwise by a
+        detached process that keeps running after the recorder exits
+        """
+
+        if not self.config.rec.offload:
+            return
+        target = self.config.rec.offload
+        ratelimit = (self.config.rec.offloadrate or 0) * 1e6
+        journal = self.setupdir+"/offload.json"
+        offloader = getattr(self, "offloader", None)
+        if offloader is None or offloader.target != target or \
+           offloader.start != keepopen:
+            self._detachoffload()
+            self.offloader = Offload(target, journal, ratelimit = ratelimit,
+                                     start = keepopen)
+        self.offloader.ratelimit = ratelimit
+        files = self._recorded(directory)
+        for filename in files:
+            self.offloader.add(filename, directory)
+        if not keepopen:
+            detach(target, journal, ratelimit, self.logfolder+"/offload.log")
+        lineprint("Offloading "+str(len(files))+" files to "+target+"..")
+
+
+    def _detachoffload(self):
+
+        """Stops the offload thread of this process, if any, and hands the
+        remaining transfers over to a detached process"""
+
+        offloader = getattr(self, "offloader", None)
+        self.offloader = None
+        if offloader is None or not offloader.start:
+            return
+        offloader.stop()
+        offloader.wait()
+        if offloader.pending():
+            detach(offloader.target, offloader.journalfile,
+                   offloader.ratelimit, self.logfolder+"/offload.log")
+
+
+    def _filemetrics(self, output):
+
+        """Adds the metrics of a closed video output to those of the
+        recording"""
+
+        self.metrics.addfile(output.filename, frames = output.frames,
+                             expected = output.frames + output.dropped,
+                             dropped = output.dropped, gaps = len(output.gaps),
+                             duration = output.duration(),
+                             writetime = output.writetime)
+
+
+    def _savemetrics(self):
+
+        """Stores the metrics of the recording next to the media and in the
+        Prometheus textfile if set, and logs a summary"""
+
+        if not self.config.rec.metrics:
+            return
+        metrics = self.metrics.save(self.filebase+"_metrics.json",
+                                    self.config.rec.promfile)
+        summary = "Recording metrics: "+str(metrics["files"])+" files"
+        if metrics.get("frames") is not None:
+            summary += ", "+str(metrics["frames"])+" frames"
+        if metrics.get("expected") is not None:
+            summary += " of "+str(metrics["expected"])+" expected"
+        if metrics.get("dropped") is not None:
+            summary += ", "+str(metrics["dropped"])+" dropped"
+        if metrics.get("bitrate") is not None:
+            summary += ", "+str(round(metrics["bitrate"]/1000000.,2))+" Mbps"
+        lineprint(summary+", cpu "+str(metrics["cpu_percent"])+"%, max rss "+\
+                  str(round(metrics["maxrss"]/1000000.,1))+" MB..")
+
+
+    def _frameoutput(self, filename):
+
+        """Returns an output for the video encoder that writes to filename and,
+        if frametimes is set, stores the timing of each frame next to it"""
+
+        sidecar = None
+        if self.config.vid.frametimes:
+            sidecar = filename[:-len(self.filetype)]+"_frames.bin"
+
+        return FrameOutput(self.cam, filename, sidecar = sidecar)
+
+
+    def _motionoutput(self, filename):
+
+        """Returns a motion vector output that stores the activity of each
+        frame next to the video if motionvectors is set"""
+
+        if not self.config.vid.motionvectors:
+            return None
+        base = filename[:-len(self.filetype)] if filename.endswith(self.filetype) else filename
+
+        return MotionVectors(self.resize, base+"_motion.bin", camera = self.cam)
+
+
+    def _startpreview(self):
+
+        """
+        Starts a low-resolution preview on the camera's second splitter port
+        if preview is set, using the hardware resizer, so that the frames of
+        a running recording can be viewed. Needs to be started after the main
+        recording so that the frame information of the main recording is used
         """
 
-        self._setup_cam(auto=True)
-        with self.rawCapture as stream:
-            for a in range(5):
-                self.cam.capture(stream, format="bgr", use_video_port=True)
-                image = stream.array
-                stream.seek(0)
-                stream.truncate()
+        fmt = self._previewformat()
+        if not fmt:
+            return
+        dims = tuple(self.config.vid.previewdims or (320,240))
+        preview = getattr(self, "preview", None)
+        if preview is None or preview.format != fmt or preview.resolution != dims:
+            self.preview = PreviewOutput(dims, format = fmt)
+        self.preview.reset()
+        view = getattr(self, "liveview", None)
+        if self.config.vid.liveview and (view is None or view.source is not \
+           self.preview or view.port != int(self.config.vid.liveview)):
+            from .liveview import LiveView
+            if view is not None:
+                view.stop()
+            self.liveview = LiveView(self.preview,
+                                     port = int(self.config.vid.liveview)).start()
+        self.cam.start_recording(self.preview, format = fmt, splitter_port = 2,
+                                 resize = dims)
+
+
+    def _previewformat(self):
+
+        """Returns the format of the preview, mjpeg if only liveview is set"""
+
+        if self.config.vid.preview:
+            return self.config.vid.preview
+        if self.config.vid.liveview:
+            return "mjpeg"
+        return None
+
+
+    def _stoppreview(self, fps = None):
 
-            self.config.cam.shutterspeed = self.cam.exposure_speed
-            self.config.cus.gains = tuple([round(float(i),2) for i in self.cam.awb_gains])
-            self.config.save()
-            lineprint("Shutterspeed set to "+str(self.cam.exposure_speed))
-            lineprint("White balance gains set to "+str(self.config.cus.gains))
+        """Stops the preview and reports the framerate of the recording and
+        the preview"""
+
+        if not self._previewformat():
+            return
+        self.cam.stop_recording(splitter_port = 2)
+        self.preview.close()
+        rate = str(self.preview.rate())+" fps ("+str(self.preview.frames())+\
+               " frames)"
+        if fps is None:
+            lineprint("Preview at "+rate)
+        else:
+            lineprint("Recorded at "+str(round(fps,2))+" fps, preview at "+rate)
+
+
+    def _motionframe(self, width = 160):
+
+        """Captures a small grayscale frame through the video port"""
+
+        if not hasattr(self, "motionbuf"):
+            res = self.resize if self.resize is not None else self.cam.resolution
+            height = max(16, int(round(width*res[1]/float(res[0])/16.))*16)
+            self.motiondims = (width, height)
+            self.motionbuf = np.empty((int(width*height*1.5),), dtype=np.uint8)
+        width, height = self.motiondims
+        self.cam.capture(self.motionbuf, format = "yuv", use_video_port = True,
+                         resize = self.motiondims)
+
+        return self.motionbuf[:width*height].reshape((height, width))
+
+
+    def _vidmotion(self, interval = 0.25):
+
+        """
+        Watches for motion for vidduration + viddelay seconds while keeping the
+        last motionpre seconds of video in a circular in-memory buffer. When
+        motion is detected, the buffered video and all video until motionpost
+        seconds after the last detected motion are written to a new file. Each
+        trigger decision is stored in a "_triggers.csv" file.
+        """
+
+        import picamera
+
+        pre = self.config.vid.motionpre
+        pre = 5 if pre is None else pre
+        post = self.config.vid.motionpost
+        post = 5 if post is None else post
+        threshold = self.config.vid.motionthresh or 0.01
+        detector = FrameDiff(threshold = threshold)
+        self._stamp()
+        vectors = self._motionoutput(self.filebase)
+        if hasattr(self, "motionbuf"):
+            del self.motionbuf
+
+        stream = picamera.PiCameraCircularIO(self.cam, seconds = max(pre, 1))
+        self._waitstart()
+        self.cam.start_recording(stream, format = "h264", resize = self.resize,
+                                 quality = self.config.vid.vidquality,
+                                 intra_period = int(self.config.vid.vidfps),
+                                 motion_output = vectors, level = "4.2")
+        self._started()
+        self._startpreview()
+        lineprint("Start watching for motion..")
+        log = open(self.filebase+"_triggers.csv", "w")
+        log.write("time,event,activity,file\n")
+
+        output = None
+        nr = 0
+        lastmotion = 0
+        end = monotonic() + self.config.vid.vidduration + self.config.vid.viddelay
+        while monotonic() < end:
+            self.cam.wait_recording(interval)
+            if vectors is not None:
+                activity = vectors.peak()
+                motion = activity > threshold
+            else:
+                activity, motion = detector.update(self._motionframe())
+            now = monotonic()
+            if motion:
+                lastmotion = now
+            if motion and output is None:
+                nr += 1
+                output = TriggerOutput(self.filename+strftime("%H%M%S")+\
+                                       "_M%02d" % nr+self.filetype,
+                                       fps = float(self.cam.framerate))
+                self.cam.request_key_frame()
+                self.cam.split_recording(output)
+                stream.copy_to(output.file, seconds = pre,
+                               first_frame = picamera.PiVideoFrameType.sps_header)
+                stream.clear()
+                output.release()
+                event = "start"
+                lineprint("Motion detected, recording "+output.filename)
+            elif output is not None and not motion and now - lastmotion > post:
+                self.cam.request_key_frame()
+                self.cam.split_recording(stream)
+                output.close()
+                self.metrics.addfile(output.filename)
+                event = "stop"
+                lineprint("No motion for "+str(post)+"s, finished "+output.filename)
+            else:
+                event = "motion" if motion else "none"
+            log.write("%s,%s,%.5f,%s\n" % (datetime.now().isoformat(), event,
+                      activity, "" if output is None else \
+                      os.path.basename(output.filename)))
+            if event == "stop":
+                output = None
+
+        self.cam.stop_recording()
+        self._stoppreview()
+        if output is not None:
+            output.close()
+            self.metrics.addfile(output.filename)
+            lineprint("Finished recording "+output.filename)
+        if vectors is not None:
+            vectors.close()
+        log.close()
+        lineprint("Finished watching for motion, "+str(nr)+" recordings made..")
+
+
+    def autoconfig(self, keepopen = False, dims = (160, 128), timeout = 10):
+
+        """
+        Sets the shutterspeed and white balance automatically using the
+        framerate provided in the configuration file. The camera meters on a
+        small stream on a separate splitter port until the exposure and gains
+        have converged, so that no full-resolution frames are captured. When
+        the camera is already open, e.g. with keepopen during a long recording
+        session, it is recalibrated without reopening it. When the camera is
+        kept open, it is left in the recording state: the new values are
+        applied directly if automode is off, as are the image settings.
+
+        Parameters
+        ----------
+        keepopen : bool, default = False
+            If the camera should be kept open after calibration.
+        dims : tuple, default = (160, 128)
+            The resolution of the metering stream.
+        timeout : float, default = 10
+            The maximum time in seconds to wait for convergence.
+        """
 
-        stream.close()
-        self.rawCapture.close()
-        self.cam.close()
+        start = monotonic()
+        fresh = getattr(self, "cam", None) is None or self.cam.closed
+        if fresh:
+            self._setup_cam(auto = True, warmup = False)
+        else:
+            self.cam.shutter_speed = 0
+            self.cam.exposure_mode = "auto"
+            self.cam.awb_mode = "auto"
+
+        meter = FrameCounter(dims)
+        self.cam.start_recording(meter, format = "yuv", resize = dims,
+                                 splitter_port = 3)
+        converged, _, _ = converge(self.cam, timeout = timeout)
+        self.cam.stop_recording(splitter_port = 3)
+
+        self.config.cam.shutterspeed = int(self.cam.exposure_speed)
+        self.config.cus.gains = tuple([round(float(i),2) for i in self.cam.awb_gains])
+        self.config.save()
+        if not fresh or keepopen:
+            self._recstate()
+        self.calibtime = monotonic() - start
+        lineprint("Shutterspeed set to "+str(self.config.cam.shutterspeed))
+        lineprint("White balance gains set to "+str(self.config.cus.gains))
+        lineprint("Calibration "+("converged" if converged else "timed out")+\
+                  " in "+str(round(self.calibtime,2))+"s ("+\
+                  str(meter.frames)+" frames)..")
+
+        if fresh and not keepopen:
+            self.cam.close()
 
 
     def settings(self, **kwargs):
@@ -280,19 +1045,55 @@ class PiRecorder:
             If different, a folder with name corresponding to location will be
             created inside the home directory. If no name is provided (""), the
             files are stored in the home directory. If "NAS" is provided it will
-            additionally check if the folder links to a mounted drive.
+            additionally check if the folder links to a mounted drive. To store
+            recordings on a NAS without depending on the network while
+            recording, use a local recdir with offload instead.
         subdirs : bool, default = False
             If files of individual recordings should be stored in subdirectories
             or not, to keep all files of a single recording session together.
+        preflight : ["warn", "fallback", None], default = "warn"
+            Before each recording, estimate its size and needed write rate from
+            the configuration and check them against the free space and write
+            throughput of recdir, measured with a short benchmark that is
+            cached per storage device. With "warn" a warning is shown when the
+            recording may not fit or may stall, with "fallback" recordings are
+            then stored in the local pirecorder/recordings directory instead.
+        metrics : bool, default = True
+            If the performance metrics of each recording, such as the warm-up
+            time, frames captured, expected and dropped, bitrate and write
+            time per file, and cpu time and peak memory, should be stored in a
+            "_metrics.json" file next to the recorded media.
+        promfile : str, default = None
+            Optional file to which the metrics of the last recording are
+            written in the Prometheus textfile format, for example in the
+            textfile collector directory of node_exporter.
+        offload : str, default = None
+            Optional directory, e.g. a mounted NAS, to which all files of each
+            recording are moved in the background after the recording has
+            finished, by a separate process that keeps running after the
+            recorder exits, or when the camera is kept open by the recorder
+            itself until it is closed. Files are verified with their checksum
+            before the local copy is deleted, and interrupted transfers are
+            resumed.
+        offloadrate : float, default = 0
+            The maximum offload transfer rate in MB/s, so that offloading does
+            not affect a running recording, 0 for no limit.
         label : str, default = "test"
             Label that will be associated with the specific recording and stored
             in the filenames.
-        rectype : ["img", "imgseq", "vid", "vidseq"], default = "img"
+        rectype : ["img", "imgseq", "imgraw", "vid", "vidseq", "vidmotion"], default = "img"
             Recording type, either a single image or video or a sequence of
-            images or videos.
+            images or videos, a sequence of unencoded frames stored in a single
+            numpy file, or videos that are only stored when motion is detected.
         automode : bool, default = True
             If the shutterspeed and white balance should be set automatically
             and dynamically for each recording.
+        warmup : ["fixed", "converge"], default = "fixed"
+            How the camera warms up before recording. With "fixed" the camera
+            always waits 2-10s depending on the framerate and automode. With
+            "converge" the exposure speed, gains and white balance gains are
+            polled and recording starts as soon as they are stable, with the
+            fixed waiting time as the maximum.
         maxres : str or tuple, default = "v2"
             The maximum potential resolution of the camera used. Either provide
             a tuple of the max resolution, or use "v1.5", "v2" (default), or
@@ -345,7 +1146,11 @@ class PiRecorder:
             considerably due to the raspberry pi hardware. To control for this,
             automatically a standard `imgwait` time should be chosen that is at
             least 6x the shutterspeed. For example, for a shutterspeed of 300000
-            imgwait should be > 1.8s.
+            imgwait should be > 1.8s. With automode off, images with a
+            shutterspeed above 1/6th of a second are taken in long-exposure
+            mode, which keeps the camera in a long-exposure sensor mode with
+            fixed gains and captures through the video port, so that imgwait
+            only needs to be just longer than the shutterspeed.
         imgdims : tuple, default = (2592, 1944)
             The resolution of the images to be taken in pixels. The default is
             the max resolution for the v1.5 model, the v2 model has a max
@@ -370,6 +1175,37 @@ class PiRecorder:
         imgnr : int, default = 12
             The number of images that should be taken. When this number is
             reached, the recorder will automatically terminate.
+        burst : bool, default = False
+            If image sequences should be captured in burst mode, through the
+            camera's video port with images written to disk in the background.
+            This allows for an imgwait down to 0.066s (up to 15 images per
+            second at full resolution), at the cost of somewhat lower image
+            quality. What happens when storage cannot keep up is set with
+            writepolicy. With the default "block" capturing waits until an
+            image is written, delaying the next images as set with overrun,
+            with "dropoldest" waiting images are dropped. Both are reported at
+            the end of the recording.
+        overrun : ["skip", "catchup"], default = "skip"
+            What to do when capturing an image in an image sequence takes
+            longer than imgwait. Images are taken at fixed deadlines from the
+            start of the sequence. With "skip" missed deadlines are skipped,
+            with "catchup" images for missed deadlines are taken immediately.
+            The planned and actual time of each image and the jitter statistics
+            are stored in a "_timing.csv" file next to the images.
+        writequeue : int, default = 16
+            Images of image sequences are captured into memory and written to
+            disk in the background. This sets the maximum number of images
+            that can be waiting to be written. The write time and latency of
+            each image are stored in a "_writes.csv" file next to the images.
+        writepolicy : ["block", "dropoldest", "spill"], default = "block"
+            What to do when the write queue is full: wait for an image to be
+            written, drop the oldest waiting image, or spill the oldest waiting
+            image to tmpfs (/dev/shm) to be moved to recdir later.
+        rawformat : ["gray", "bgr"], default = "gray"
+            For imgraw recordings, if the grayscale (Y) plane or BGR frames
+            should be stored. Frames are stored unencoded in a memory-mapped
+            .npy file that can be opened without copying with np.load(filename,
+            mmap_mode="r") or rawarray.readraw.
         imgtime : integer, default = 60
             The time in seconds during which images should be taken. The minimum
             of a) imgnr and b) nr of images based on imgwait and imgtime will be
@@ -385,12 +1221,75 @@ class PiRecorder:
             Its use is to add a standard amount of time to the video that can be
             easily cropped or skipped, such as for tracking, but still provides
             useful information, such as behaviour during acclimation.
+        vidsegment : int, default = 0
+            If larger than 0, videos are recorded continuously for vidduration
+            plus viddelay seconds and split into segments of vidsegment seconds
+            each without losing frames between segments. This also makes vidseq
+            recordings run unattended. A "_segments.csv" manifest with the
+            number of frames and duration of each segment is stored next to
+            the videos.
+        motionpre : int, default = 5
+            For vidmotion recordings, the number of seconds of video before the
+            motion was detected that is included in the recording.
+        motionpost : int, default = 5
+            For vidmotion recordings, the number of seconds to keep recording
+            after the last detected motion.
+        motionthresh : float, default = 0.01
+            For vidmotion recordings, the fraction of pixels within the roi
+            that need to change between subsequent checks to detect motion.
+        motionvectors : bool, default = False
+            If the motion activity of each video frame should be computed from
+            the encoder's motion vectors and stored as a binary time series in
+            a "_motion.bin" file next to each video (see motion.readmotion).
+            For vidmotion recordings the motion vectors are then also used to
+            detect motion, with motionthresh the fraction of macroblocks that
+            need to move.
+        frametimes : bool, default = True
+            If the index, presentation timestamp, keyframe flag and encoded size
+            of each video frame should be stored in a "_frames.bin" file next to
+            each video (see frames.readframes). This allows exact timing to be
+            reconstructed, for example by Convert, without decoding the video.
+        vidformat : ["h264", "mp4"], default = "h264"
+            The format in which videos are stored. With "mp4" the encoded video
+            is streamed into an MP4 container by ffmpeg while recording, so
+            that videos are directly playable without a separate Convert step.
+            Requires ffmpeg to be installed, otherwise h264 is recorded.
+        preview : [None, "mjpeg", "bgr"], default = None
+            If a low-resolution preview of video recordings should be produced
+            alongside the main recording, using the camera's second splitter
+            port. The most recent preview frame, either jpeg-encoded or a BGR
+            numpy array, is available with the recorder's preview.read() and is
+            used by the live-view server. The framerates achieved by the
+            recording and the preview are reported after each recording.
+        previewdims : tuple, default = (320, 240)
+            The resolution of the preview, resized by the camera's hardware
+            resizer.
+        liveview : int, default = 0
+            If larger than 0, the port of a live-view web server that serves the
+            preview of running video recordings as MJPEG video (/stream.mjpg)
+            and single snapshots (/snapshot.jpg), e.g. http://<pi>:8000. If no
+            preview is set an mjpeg preview is used.
+        dropthresh : float, default = 0
+            Video recordings are monitored for dropped frames while recording,
+            based on the gaps between frame timestamps, and gaps are logged as
+            they happen. If larger than 0, the fraction of dropped frames of a
+            file above which the dropaction is taken, e.g. 0.01 for 1%.
+        dropaction : ["alert", "abort"], default = "alert"
+            What to do when more frames are dropped than dropthresh, either
+            log a warning or stop the recording.
         vidquality : int, default = 11
             Specifies the quality that the h264 encoder should attempt to
             maintain. Use values between 10 and 40, where 10 is extremely high
             quality, and 40 is extremely low.
         """
 
+        transaction = getattr(self, "pending", None) is not None
+        if self.config.changed() and not transaction:
+            self.config.load()
+        for key, value in kwargs.items():
+            if key not in ["internal", "maxres"]:
+                validate(key, value)
+
         if "recdir" in kwargs:
             self.config.rec.recdir = kwargs["recdir"]
         if "subdirs" in kwargs:
@@ -418,6 +1317,8 @@ class PiRecorder:
 
         if "automode" in kwargs:
             self.config.cam.automode = kwargs["automode"]
+        if "warmup" in kwargs:
+            self.config.cam.warmup = kwargs["warmup"]
         if "brightness" in kwargs:
             self.config.cam.brightness = kwargs["brightness"]
         if "contrast" in kwargs:
@@ -446,6 +1347,16 @@ class PiRecorder:
             self.config.img.imgwait = kwargs["imgwait"]
         if "imgnr" in kwargs:
             self.config.img.imgnr = kwargs["imgnr"]
+        if "burst" in kwargs:
+            self.config.img.burst = kwargs["burst"]
+        if "overrun" in kwargs:
+            self.config.img.overrun = kwargs["overrun"]
+        if "writequeue" in kwargs:
+            self.config.img.writequeue = kwargs["writequeue"]
+        if "writepolicy" in kwargs:
+            self.config.img.writepolicy = kwargs["writepolicy"]
+        if "rawformat" in kwargs:
+            self.config.img.rawformat = kwargs["rawformat"]
         if "imgtime" in kwargs:
             self.config.img.imgtime = kwargs["imgtime"]
         if "imgquality" in kwargs:
@@ -455,35 +1366,129 @@ class PiRecorder:
             self.config.vid.vidduration = kwargs["vidduration"]
         if "viddelay" in kwargs:
             self.config.vid.viddelay = kwargs["viddelay"]
+        if "vidsegment" in kwargs:
+            self.config.vid.vidsegment = kwargs["vidsegment"]
+        if "motionpre" in kwargs:
+            self.config.vid.motionpre = kwargs["motionpre"]
+        if "motionpost" in kwargs:
+            self.config.vid.motionpost = kwargs["motionpost"]
+        if "motionthresh" in kwargs:
+            self.config.vid.motionthresh = kwargs["motionthresh"]
+        if "motionvectors" in kwargs:
+            self.config.vid.motionvectors = kwargs["motionvectors"]
+        if "frametimes" in kwargs:
+            self.config.vid.frametimes = kwargs["frametimes"]
+        if "vidformat" in kwargs:
+            self.config.vid.vidformat = kwargs["vidformat"]
+        if "preview" in kwargs:
+            self.config.vid.preview = kwargs["preview"]
+        if "previewdims" in kwargs:
+            self.config.vid.previewdims = kwargs["previewdims"]
+        if "liveview" in kwargs:
+            self.config.vid.liveview = kwargs["liveview"]
+        if "dropthresh" in kwargs:
+            self.config.vid.dropthresh = kwargs["dropthresh"]
+        if "dropaction" in kwargs:
+            self.config.vid.dropaction = kwargs["dropaction"]
+        if "preflight" in kwargs:
+            self.config.rec.preflight = kwargs["preflight"]
+        if "metrics" in kwargs:
+            self.config.rec.metrics = kwargs["metrics"]
+        if "promfile" in kwargs:
+            self.config.rec.promfile = kwargs["promfile"]
+        if "offload" in kwargs:
+            self.config.rec.offload = kwargs["offload"]
+        if "offloadrate" in kwargs:
+            self.config.rec.offloadrate = kwargs["offloadrate"]
         if "vidquality" in kwargs:
             self.config.vid.vidquality = kwargs["vidquality"]
 
+        if transaction:
+            self.pending.update(kwargs)
+        else:
+            self._commit(kwargs)
+
+
+    @contextmanager
+    def transaction(self):
+
+        """
+        Batches multiple settings() calls so that all settings are validated
+        before any is applied, the derived image parameters are computed once,
+        and the configuration file is written once, atomically, at the end
+        and only if something changed. If an error occurs, all settings of
+        the transaction are rolled back.
+
+        Example
+        -------
+        >>> with rec.transaction():
+        ...     rec.settings(rectype = "vid", vidduration = 60)
+        ...     rec.settings(viddims = (1640, 1232), vidfps = 30)
+        """
+
+        if getattr(self, "pending", None) is not None:
+            yield self
+            return
+        backup = self.config.copy()
+        self.pending = {}
+        try:
+            yield self
+        except Exception:
+            self.config.values = backup
+            raise
+        finally:
+            pending, self.pending = self.pending, None
+        self._commit(pending)
+
+
+    def _commit(self, kwargs):
+
+        """Applies the derived parameters and stores the configuration if
+        anything changed"""
+
         brightchange = False
-        if os.path.exists(self.brightfile):
-            with open(self.brightfile) as f:
-                brighttune = yaml.load(f, Loader=yaml.FullLoader)
-                if brighttune != self.config.cus.brighttune:
-                    self.config.cus.brighttune = brighttune
-                    brightchange = True
+        brighttune = self._brighttune()
+        if brighttune is not None and brighttune != self.config.cus.brighttune:
+            self.config.cus.brighttune = brighttune
+            brightchange = True
 
         if len(kwargs) > 0 or brightchange:
 
             self._imgparams()
             self._shuttertofps()
-            if self.config.rec.rectype == "imgseq":
-                if self.config.cam.shutterspeed/1000000. >= (self.config.img.imgwait/5):
-                    lineprint("imgwait is not enough for provided shutterspeed" + \
-                              ", will be overwritten..")
-            self.config.save()
+            self._checkimgwait()
+            saved = self.config.save()
 
             if "internal" not in kwargs:
-                lineprint("Config settings stored and loaded..")
+                if saved:
+                    lineprint("Config settings stored and loaded..")
+                else:
+                    lineprint("Config settings unchanged..")
+
+
+    def _brighttune(self):
+
+        """Returns the brightness tuning factor stored in the cusbright file,
+        only reading the file again when it has been modified"""
+
+        try:
+            mtime = os.stat(self.brightfile).st_mtime_ns
+        except OSError:
+            return None
+        if getattr(self, "brightmtime", None) != mtime:
+            with open(self.brightfile) as f:
+                self.brightvalue = yaml.load(f, Loader=yaml.FullLoader)
+            self.brightmtime = mtime
+
+        return self.brightvalue
 
 
     def stream(self, fps = None):
 
         """Shows an interactive video stream"""
 
+        from .stream import Stream
+
         lineprint("Opening stream for cam positioning and roi extraction..")
         vidstream = Stream(internal=True, rotation=self.config.cus.rotation,
                        maxres=self.config.rec.maxres)
@@ -495,6 +1500,8 @@ class PiRecorder:
 
     def camconfig(self, fps=None, vidsize=0.4):
 
+        from .camconfig import Camconfig
+
         lineprint("Opening stream for interactive configuration..")
         fps = max(self.config.vid.vidfps,1) if fps==None else int(fps)
         self._setup_cam(fps=fps)
@@ -505,7 +1512,7 @@ class PiRecorder:
 
 
     def schedule(self, jobname = None, timeplan = None, enable = True,
-                 showjobs = False, delete = None, test = False):
+                 showjobs = False, delete = None, test = False, daemon = False):
 
         """
         Schedule future recordings
@@ -547,6 +1554,11 @@ class PiRecorder:
             The name of the configuration file to be used for the scheduled
             recordings. Make sure the file exists, otherwise the default
             configuration settings will be used.
+        daemon : bool, default = False
+            If the scheduled job should request the recording from a running
+            recorder daemon (see RecDaemon) that keeps the camera open and warm,
+            rather than starting a new recorder process. If no daemon is running
+            when the job starts the recording is run directly.
 
         Note: Make sure Recorder configuration timing settings are within the
         timespan between subsequent scheduled recordings based on the provided
@@ -555,76 +1567,152 @@ class PiRecorder:
         This will be checked automatically.
         """
 
+        from .schedule import Schedule
+
         S = Schedule(jobname, timeplan, enable, showjobs, delete, test,
                      logfolder = self.logfolder, internal=True,
-                     configfile = self.configfilerel)
+                     configfile = self.configfilerel, daemon = daemon)
+
+
+    def close(self):
+
+        """Releases the camera if it is still open, stops the live view, and
+        hands any remaining offload transfers to a detached process"""
+
+        if getattr(self, "cam", None) is not None and not self.cam.closed:
+            self.cam.close()
+        self._detachoffload()
+        if getattr(self, "liveview", None) is not None:
+            self.liveview.stop()
+            self.liveview = None
 
 
-    def record(self):
+    def record(self, keepopen = False, start_at = None):
 
         """
         Starts a recording as configured and returns either one or multiple
-        .h264 or .jpg files that are named automatically according to the label,
+        .h264, .mp4 or .jpg files that are named automatically according to the label,
         the host name, date, time and potentially session number or count nr.
 
+        Parameters
+        ----------
+        keepopen : bool, default = False
+            If the camera should be kept open and warm after the recording so
+            that subsequent recordings can start immediately. When the camera
+            is already open it is used directly without setting it up again.
+            Use the close() method to release the camera.
+        start_at : float, datetime or str, default = None
+            The wall-clock time at which the recording should start, as a unix
+            timestamp, a datetime, or a string such as "10:30:00.5" for today
+            or "2020-05-01 10:30:00.5". The camera is set up and warmed up
+            first, after which the recording starts precisely at the provided
+            time. The achieved start error, measured when the camera call
+            that starts the recording returns, or for image sequences when the
+            first image is captured, is logged, stored as starterror and
+            added to the metrics. Call record at least the camera warm-up time before
+            start_at. By default the recording starts directly.
+
         Example output files:
         rectype = "img" : test_180312_pi13_101300.jpg
         rectype = "vid" : test_180312_pi13_102352.h264
         rectype = "imgseq" : test_180312_pi13_img00231_101750.jpg
+        rectype = "imgraw" : test_180312_pi13_101750.npy
         rectype = "vidseq" : test_180312_pi13_101810_S01.h264
         """
 
-        self._setup_cam()
+        self.startdeadline = None if start_at is None else todeadline(start_at)
+        self.starterror = None
+        self.startmark = None
+        self.metrics = Metrics(self.config.rec.rectype, self.config.rec.label,
+                               self.host)
+        os.chdir(self.recdir)
+        self._preflight()
+        localdir = os.getcwd()
+        fresh = getattr(self, "cam", None) is None or self.cam.closed
+        if fresh:
+            self._setup_cam()
+        else:
+            self.warmuptime = 0.
+        self.metrics.set(warmup = round(self.warmuptime, 3))
         self._namefile()
 
         if self.config.rec.rectype == "img":
 
-            self.filename = self.filename + strftime("%H%M%S") + self.filetype
+            self._waitstart(lead = 0.5)
+            self.filename = self.filename + self._stamp() + self.filetype
+            self._waitstart()
+            start = monotonic()
             self.cam.capture(self.filename, format="jpeg", resize = self.resize,
-                             quality = self.config.img.imgquality)
+                             quality = self.config.img.imgquality,
+                             use_video_port = self.longexpo)
+            self._started()
+            self.metrics.addfile(self.filename, frames = 1, expected = 1,
+                                 dropped = 0, writetime = monotonic() - start)
             lineprint("Captured "+self.filename)
 
         elif self.config.rec.rectype == "imgseq":
 
-            timepoint = datetime.now()
-            for i, img in enumerate(self.cam.capture_continuous(self.filename,
-                                    format="jpeg", resize = self.resize,
-                                    quality = self.config.img.imgquality)):
-                if i < self.config.img.imgnr-1:
-                    timepassed = (datetime.now() - timepoint).total_seconds()
-                    delay = max(0, self.config.img.imgwait - timepassed)
-                    lineprint("Captured "+img+", sleeping "+str(round(delay,2))+"s..")
-                    sleep(delay)
-                    timepoint = datetime.now()
-                else:
-                    lineprint("Captured "+img)
-                    break
+            self._waitstart(lead = 0.5)
+            self._imgseq()
+
+        elif self.config.rec.rectype == "imgraw":
+
+            self._waitstart(lead = 0.5)
+            self._imgraw()
 
-        elif self.config.rec.rectype in ["vid","vidseq"]:
+        elif self.config.rec.rectype in ["vid","vidseq","vidmotion"]:
 
             # Temporary fix for flicker at start of (first) video
-            self.cam.start_recording(BytesIO(), format = "h264",
-                                     resize = self.resize, level = "4.2")
-            self.cam.wait_recording(2)
-            self.cam.stop_recording()
-
-            for session in ["_S%02d" % i for i in range(1,999)]:
-                session = "" if self.config.rec.rectype == "vid" else session
-                filename = self.filename+strftime("%H%M%S")+session+self.filetype
-                self.cam.start_recording(filename, resize = self.resize,
-                                         quality = self.config.vid.vidquality,
-                                         level = "4.2")
-                lineprint("Start recording "+filename)
-                self.cam.wait_recording(self.config.vid.vidduration+self.config.vid.viddelay)
+            if fresh:
+                self.cam.start_recording(BytesIO(), format = "h264",
+                                         resize = self.resize, level = "4.2")
+                self.cam.wait_recording(2)
                 self.cam.stop_recording()
-                lineprint("Finished recording "+filename)
-                if self.config.rec.rectype == "vid":
-                    break
-                else:
-                    msg = "\nPress Enter for new session, or e and Enter to exit: "
-                    if input(msg) == "e":
+            self._waitstart(lead = 0.5)
+
+            if self.config.rec.rectype == "vidmotion":
+                self._vidmotion()
+
+            elif self.config.vid.vidsegment:
+                self._vidsegments()
+
+            else:
+                for session in ["_S%02d" % i for i in range(1,999)]:
+                    session = "" if self.config.rec.rectype == "vid" else session
+                    filename = self.filename+self._stamp()+session+self.filetype
+                    output = self._frameoutput(filename)
+                    motion = self._motionoutput(filename)
+                    self._waitstart()
+                    self.cam.start_recording(output, format = "h264",
+                                             resize = self.resize,
+                                             quality = self.config.vid.vidquality,
+                                             motion_output = motion,
+                                             level = "4.2")
+                    self._started()
+                    self._startpreview()
+                    lineprint("Start recording "+filename)
+                    duration = self.config.vid.vidduration+self.config.vid.viddelay
+                    completed = self._watchframes(output, monotonic()+duration)
+                    self.cam.stop_recording()
+                    output.close()
+                    self._stoppreview((output.frames-1)/max(output.duration(), 1e-6))
+                    if motion is not None:
+                        motion.close()
+                    self._filemetrics(output)
+                    lineprint("Finished recording "+filename+" ("+\
+                              output.summary()+")")
+                    if self.config.rec.rectype == "vid" or not completed:
                         break
-        self.cam.close()
+                    else:
+                        msg = "\nPress Enter for new session, or e and Enter to exit: "
+                        if input(msg) == "e":
+                            break
+
+        self._savemetrics()
+        self._offload(localdir, keepopen)
+
+        if not keepopen:
+            self.close()
 
 
 def rec():
@@ -638,10 +1726,15 @@ def rec():
                         default="pirecorder.conf",
                         action="store",
                         help="pirecorder configuration file")
+    parser.add_argument("-s",
+                        "--startat",
+                        default=None,
+                        action="store",
+                        help="time to start recording, e.g. 10:30:00.5")
     args = parser.parse_args()
     if not isrpi():
         lineprint("PiRecorder only works on a raspberry pi. Exiting..")
         return
     rec = PiRecorder(args.configfile)
     rec.settings(internal = True)
-    rec.record()
+    rec.record(start_at = args.startat)
@@ -0,0 +1,145 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2020 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import numpy as np
+
+from time import monotonic
+from threading import Condition
+
+class PreviewOutput:
+
+    """
+    Output for a second splitter port of the camera that keeps only the most
+    recent low-resolution preview frame, either as raw BGR frames or as MJPEG
+    frames, while the main recording continues on the first splitter port.
+    Frames are resized by the camera's hardware resizer so that no resizing is
+    done in Python. Consumers can wait for new frames with wait().
+
+    Parameters
+    ----------
+    resolution : tuple
+        The resolution of the preview frames.
+    format : ["mjpeg", "bgr"], default = "mjpeg"
+        The format of the preview frames, either jpeg-encoded images or numpy
+        arrays of BGR pixel values.
+    """
+
+    def __init__(self, resolution, format = "mjpeg"):
+
+        self.resolution = tuple(resolution)
+        self.format = format
+        width, height = self.resolution
+        self.rawdims = ((width + 31) // 32 * 32, (height + 15) // 16 * 16)
+        self.rawsize = self.rawdims[0] * self.rawdims[1] * 3
+
+        self.frame = None
+        self.count = 0
+        self.startcount = 0
+        self.start = None
+        self.last = None
+        self.buf = bytearray()
+        self.condition = Condition()
+
+
+    def write(self, buf):
+
+        if self.format == "mjpeg":
+            if buf.startswith(b"\xff\xd8") and len(self.buf) > 0:
+                self._newframe(bytes(self.buf))
+                self.buf = bytearray()
+            self.buf.extend(buf)
+        else:
+            self.buf.extend(buf)
+            while len(self.buf) >= self.rawsize:
+                raw = np.frombuffer(bytes(self.buf[:self.rawsize]), dtype=np.uint8)
+                width, height = self.resolution
+                frame = raw.reshape((self.rawdims[1], self.rawdims[0], 3))
+                self._newframe(frame[:height, :width])
+                del self.buf[:self.rawsize]
+
+        return len(buf)
+
+
+    def _newframe(self, frame):
+
+        now = monotonic()
+        with self.condition:
+            if self.start is None:
+                self.start = now
+                self.startcount = self.count
+            self.last = now
+            self.frame = frame
+            self.count += 1
+            self.condition.notify_all()
+
+
+    def read(self):
+
+        """Returns the most recent preview frame, or None if there is none"""
+
+        with self.condition:
+            return self.frame
+
+
+    def wait(self, count = 0, timeout = 1):
+
+        """Waits for a frame newer than count and returns the frame and its
+        count, or the current frame and count after timeout seconds"""
+
+        with self.condition:
+            self.condition.wait_for(lambda: self.count > count, timeout)
+            return self.frame, self.count
+
+
+    def frames(self):
+
+        """Returns the number of preview frames received since the last reset"""
+
+        if self.start is None:
+            return 0
+        return self.count - self.startcount
+
+
+    def rate(self):
+
+        """Returns the number of preview frames per second since the last
+        reset"""
+
+        if self.frames() < 2 or self.last <= self.start:
+            return 0.
+        return round((self.frames() - 1) / (self.last - self.start), 2)
+
+
+    def reset(self):
+
+        """Resets the frame rate statistics, keeping the most recent frame"""
+
+        with self.condition:
+            self.start = None
+            self.buf = bytearray()
+
+
+    def flush(self):
+
+        pass
+
+
+    def close(self):
+
+        if self.format == "mjpeg" and len(self.buf) > 0:
+            self._newframe(bytes(self.buf))
+            self.buf = bytearray()
@@ -0,0 +1,103 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2020 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import numpy as np
+
+class RawArray:
+
+    """
+    Stores unencoded camera frames in a preallocated memory-mapped .npy file,
+    either as the grayscale Y plane of yuv captures or as BGR frames. The file
+    has a standard numpy header so that it can be opened with readraw() or
+    np.load(filename, mmap_mode="r") without decoding or copying the frames.
+
+    Parameters
+    ----------
+    filename : str
+        The .npy file to store the frames in.
+    nr : int
+        The maximum number of frames to store.
+    dims : tuple
+        The (width, height) of the frames.
+    format : ["gray", "bgr"], default = "gray"
+        If the grayscale Y plane or BGR frames should be stored.
+    """
+
+    def __init__(self, filename, nr, dims, format = "gray"):
+
+        self.filename = filename
+        self.format = format
+        self.width, self.height = dims
+        self.capformat = "yuv" if format == "gray" else "bgr"
+        self.rawwidth = (self.width + 31) // 32 * 32
+        self.rawheight = (self.height + 15) // 16 * 16
+
+        if format == "gray":
+            shape = (nr, self.height, self.width)
+            bufsize = self.rawwidth * self.rawheight * 3 // 2
+        else:
+            shape = (nr, self.height, self.width, 3)
+            bufsize = self.rawwidth * self.rawheight * 3
+        self.array = np.lib.format.open_memmap(filename, mode = "w+",
+                                               dtype = np.uint8, shape = shape)
+        self.buffer = np.empty((bufsize,), dtype = np.uint8)
+        self.count = 0
+
+
+    def add(self):
+
+        """Copies the frame captured into buffer to the next frame"""
+
+        if self.format == "gray":
+            size = self.rawwidth * self.rawheight
+            frame = self.buffer[:size].reshape((self.rawheight, self.rawwidth))
+        else:
+            frame = self.buffer.reshape((self.rawheight, self.rawwidth, 3))
+        self.array[self.count] = frame[:self.height, :self.width]
+        self.count += 1
+
+
+    def close(self):
+
+        """Flushes the frames to disk and shrinks the file to the number of
+        frames stored. Returns the number of bytes stored"""
+
+        self.array.flush()
+        offset = self.array.offset
+        nr = self.array.shape[0]
+        shape = (self.count,) + self.array.shape[1:]
+        framesize = int(np.prod(self.array.shape[1:]))
+        del self.array
+
+        if self.count < nr:
+            with open(self.filename, "r+b") as f:
+                start = 10 if np.lib.format.read_magic(f) == (1, 0) else 12
+                header = "{'descr': '|u1', 'fortran_order': False, 'shape': %s, }" \
+                         % repr(shape)
+                f.seek(start)
+                f.write((header.ljust(offset - start - 1) + "\n").encode("latin1"))
+                f.truncate(offset + self.count * framesize)
+
+        return self.count * framesize
+
+
+def readraw(filename):
+
+    """Opens a file of raw frames as a read-only memory-mapped numpy array
+    with shape (frames, height, width) or (frames, height, width, 3)"""
+
+    return np.load(filename, mmap_mode = "r")
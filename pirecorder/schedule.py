@@ -39,7 +39,7 @@ class Schedule:
     def __init__(self, jobname = None, timeplan = None, enable = None,
                  showjobs = False, delete = None, test = False,
                  internal = False, configfile = "pirecorder.conf",
-                 logfolder = "/home/pi/pirecorder/"):
+                 logfolder = "/home/pi/pirecorder/", daemon = False):
 
         if internal:
             lineprint("Running schedule function.. ")
@@ -49,8 +49,12 @@ class Schedule:
         if jobname is not None:
             self.jobname = "REC_" + jobname
             pexec = sys.executable + " -c "
-            pcomm1 = """'import pirecorder; """
-            pcomm2 = """R=pirecorder.PiRecorder("%s"); R.record()'""" % configfile
+            if daemon == "True" or daemon == True:
+                pcomm1 = """'from pirecorder.daemon import recclient; """
+                pcomm2 = """recclient("%s")'""" % configfile
+            else:
+                pcomm1 = """'import pirecorder; """
+                pcomm2 = """R=pirecorder.PiRecorder("%s"); R.record()'""" % configfile
             log1 = " >> " + logfolder + "$(date +%y%m%d)_"
             log2 = str(self.jobname[4:])+".log 2>&1"
             self.task = pexec+pcomm1+pcomm2+log1+log2
@@ -202,9 +206,10 @@ def sch():
     parser.add_argument("-d","--delete", default=None, metavar="")
     parser.add_argument("-t","--test", default=False, metavar="")
     parser.add_argument("-c","--configfile", default="pirecorder.conf", metavar="")
+    parser.add_argument("-D","--daemon", default=False, metavar="")
 
     args = parser.parse_args()
     Schedule(jobname = args.jobname, timeplan = args.timeplan,
              enable = args.enable, showjobs = args.showjobs,
              delete = args.delete, test = args.test,
-             configfile = args.configfile)
+             configfile = args.configfile, daemon = args.daemon)
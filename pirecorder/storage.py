@@ -0,0 +1,108 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2020 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import time
+import yaml
+import shutil
+
+from time import monotonic
+
+VIDBITRATE = 17000000
+
+def estimate(config):
+
+    """
+    Estimates the total size in bytes of a recording with the provided
+    configuration and the sustained write rate in bytes per second it needs.
+    Videos are estimated at the encoder's maximum bitrate and jpeg images
+    based on their resolution and quality, so estimates are upper bounds
+    """
+
+    rectype = config.rec.rectype
+    if rectype in ["vid","vidseq","vidmotion"]:
+        duration = config.vid.vidduration + config.vid.viddelay
+        rate = VIDBITRATE / 8.
+        return int(rate * duration), rate
+
+    width, height = config.img.imgdims
+    if rectype == "imgraw":
+        imgsize = width * height * (1 if config.img.rawformat != "bgr" else 3)
+    else:
+        imgsize = width * height * (0.1 + 0.4 * config.img.imgquality / 100.)
+    if rectype == "img":
+        return int(imgsize), imgsize
+
+    return int(imgsize * config.img.imgnr), imgsize / config.img.imgwait
+
+
+def benchmark(directory, size = 8000000, chunksize = 1000000):
+
+    """Measures the sustained write throughput of directory in bytes per
+    second by writing and syncing a temporary file of size bytes"""
+
+    testfile = os.path.join(directory, ".pirecorder_benchmark")
+    chunk = os.urandom(chunksize)
+    start = monotonic()
+    with open(testfile, "wb") as f:
+        for _ in range(max(1, size // chunksize)):
+            f.write(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+    elapsed = max(monotonic() - start, 1e-6)
+    os.remove(testfile)
+
+    return max(1, size // chunksize) * chunksize / elapsed
+
+
+def throughput(directory, cachefile, maxage = 7*24*3600):
+
+    """Returns the write throughput of the device of directory, using the
+    cached result for the device if it is not older than maxage seconds"""
+
+    device = str(os.stat(directory).st_dev)
+    cache = {}
+    if os.path.isfile(cachefile):
+        with open(cachefile) as f:
+            cache = yaml.load(f, Loader=yaml.FullLoader) or {}
+    if device in cache and time.time() - cache[device]["time"] < maxage:
+        return cache[device]["throughput"]
+
+    rate = benchmark(directory)
+    cache[device] = {"throughput": round(rate), "time": round(time.time()),
+                     "directory": os.path.abspath(directory)}
+    with open(cachefile, "w") as f:
+        yaml.dump(cache, f)
+
+    return rate
+
+
+def preflight(directory, config, cachefile, margin = 1.5):
+
+    """
+    Checks if a recording with the provided configuration fits on the device
+    of directory and if the device can sustain the write rate it needs with
+    the provided safety margin. Returns a dictionary with the estimated size
+    and rate, free space, throughput and the outcome of both checks
+    """
+
+    size, rate = estimate(config)
+    free = shutil.disk_usage(directory).free
+    speed = throughput(directory, cachefile)
+
+    return {"size": size, "rate": rate, "free": free, "throughput": speed,
+            "fits": size * margin < free, "sustains": rate * margin < speed}
@@ -0,0 +1,367 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2020 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import print_function
+
+import time
+import socket
+import argparse
+import threading
+
+from pythutils.sysutils import lineprint, isrpi
+
+from .daemon import sendjson, recvjson
+
+
+class SyncAgent:
+
+    """
+    Agent that runs on each raspberry pi of a synchronised recording setup.
+    It listens for a SyncCoordinator that measures the clock offset of the
+    agent, arms the agent by setting up and warming up the camera, and then
+    tells it to start recording at a shared timestamp. The agent reports how
+    far its actual start was from the shared timestamp.
+
+    Parameters
+    ----------
+    configfile : str, default = "pirecorder.conf"
+        The configuration file to record with, if not provided by the
+        coordinator.
+    port : int, default = 5005
+        The tcp port the agent listens on.
+    host : str, default = ""
+        The address the agent listens on, all addresses by default.
+    logging : bool, default = True
+        If all terminal output should be stored in the pirecorder log file.
+    """
+
+    def __init__(self, configfile = "pirecorder.conf", port = 5005, host = "",
+                 logging = True):
+
+        self.configfile = configfile
+        self.port = port
+        self.host = host
+        self.logging = logging
+        self.rec = None
+        self.result = None
+        self.recording = None
+        self.stopped = False
+
+
+    def arm(self, configfile = None):
+
+        """Sets up and warms up the camera so that recording can start
+        immediately"""
+
+        from .pirecorder import PiRecorder
+
+        configfile = self.configfile if configfile is None else configfile
+        if self.recording is not None and self.recording.is_alive():
+            return {"status": "error", "message": "still recording"}
+        if self.rec is None or configfile != self.configfile:
+            if self.rec is not None:
+                self.rec.close()
+            self.rec = PiRecorder(configfile, logging = self.logging)
+            self.logging = False
+            self.configfile = configfile
+        self.rec.settings(internal = True)
+        if getattr(self.rec, "cam", None) is None or self.rec.cam.closed:
+            self.rec._setup_cam()
+        lineprint("Armed with "+configfile+"..")
+
+        return {"status": "ok", "warmup": round(self.rec.warmuptime, 3)}
+
+
+    def start(self, at):
+
+        """Starts recording at wall-clock time at, returning the difference
+        between the actual and planned start in seconds once started"""
+
+        if self.rec is None or self.rec.cam.closed:
+            return {"status": "error", "message": "not armed"}
+        self.rec.starterror = None
+
+        def record():
+            self.rec.record(keepopen = True, start_at = at)
+
+        self.recording = threading.Thread(target = record)
+        self.recording.start()
+        timeout = time.monotonic() + max(0, at - time.time()) + 5
+        while self.rec.starterror is None and time.monotonic() < timeout:
+            time.sleep(0.001)
+        self.result = self.rec.starterror
+        if self.result is None:
+            return {"status": "error", "message": "recording did not start"}
+
+        return {"status": "ok", "offset": self.result}
+
+
+    def _reply(self, request):
+
+        """Returns the reply to a single coordinator request"""
+
+        cmd = request.get("cmd")
+        if cmd == "ping":
+            return {"status": "ok", "time": time.time()}
+        elif cmd == "arm":
+            return self.arm(request.get("configfile"))
+        elif cmd == "start":
+            return self.start(request["at"])
+        elif cmd == "stop":
+            self.stopped = True
+            return {"status": "ok"}
+
+        return {"status": "error", "message": "unknown command"}
+
+
+    def _handle(self, conn):
+
+        """Answers the requests on a connection until the coordinator closes
+        it, so that the handshake pings share a single connection"""
+
+        stream = conn.makefile("rb")
+        try:
+            while True:
+                try:
+                    request = recvjson(stream)
+                    if request is None:
+                        break
+                    reply = self._reply(request)
+                except Exception as e:
+                    lineprint("Failed handling request: %r.." % (e,))
+                    reply = {"status": "error", "message": repr(e)}
+                sendjson(conn, reply)
+        except socket.error:
+            pass
+        finally:
+            stream.close()
+            conn.close()
+
+
+    def run(self):
+
+        """Serves coordinator requests until stopped"""
+
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((self.host, self.port))
+        self.port = self.server.getsockname()[1]
+        self.server.listen(5)
+        self.server.settimeout(0.5)
+        lineprint("Sync agent listening on port "+str(self.port)+"..")
+        try:
+            while not self.stopped:
+                try:
+                    conn, _ = self.server.accept()
+                except socket.timeout:
+                    continue
+                conn.settimeout(None)
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self._handle(conn)
+        except KeyboardInterrupt:
+            lineprint("User terminated sync agent..")
+        finally:
+            self.server.close()
+            if self.recording is not None:
+                self.recording.join()
+            if self.rec is not None:
+                self.rec.close()
+            lineprint("Sync agent stopped..")
+
+
+class SyncCoordinator:
+
+    """
+    Coordinates a synchronised recording start of multiple raspberry pis that
+    each run a SyncAgent. The coordinator first estimates the clock offset of
+    each agent with a handshake of multiple round trips, using the round trip
+    with the lowest delay, then arms all agents and tells them to start at a
+    shared timestamp converted to each agent's own clock.
+
+    Parameters
+    ----------
+    agents : list
+        The agents as a list of (host, port) tuples or "host:port" strings.
+    pings : int, default = 10
+        The number of round trips used to estimate the clock offset.
+
+    Example
+    -------
+    >>> sync = SyncCoordinator(["pi1:5005", "pi2:5005", "pi3:5005"])
+    >>> sync.record(delay = 2)
+    """
+
+    def __init__(self, agents, pings = 10):
+
+        self.agents = []
+        for agent in agents:
+            if isinstance(agent, str):
+                host, port = agent.rsplit(":", 1)
+                agent = (host, int(port))
+            self.agents.append(tuple(agent))
+        self.pings = pings
+        self.offsets = {}
+
+
+    def _connect(self, agent, timeout = 60):
+
+        conn = socket.create_connection(agent, timeout = timeout)
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        return conn
+
+
+    def _send(self, agent, request, timeout = 60):
+
+        conn = self._connect(agent, timeout)
+        try:
+            sendjson(conn, request)
+            with conn.makefile("rb") as stream:
+                return recvjson(stream) or {"status": "error"}
+        finally:
+            conn.close()
+
+
+    def _all(self, function):
+
+        """Runs function for all agents in parallel and returns the results"""
+
+        results = {}
+
+        def run(agent):
+            try:
+                results[agent] = function(agent)
+            except Exception as e:
+                results[agent] = {"status": "error", "message": repr(e)}
+
+        threads = [threading.Thread(target = run, args = (a,)) for a in self.agents]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return results
+
+
+    def handshake(self):
+
+        """Estimates the clock offset of each agent relative to this computer
+        in seconds, with the round trip delay as its uncertainty. All pings to
+        an agent share one connection, so that connecting does not add to the
+        measured round trips"""
+
+        def offset(agent):
+            best = None
+            conn = self._connect(agent, timeout = 5)
+            stream = conn.makefile("rb")
+            try:
+                for _ in range(self.pings):
+                    sent = time.time()
+                    sendjson(conn, {"cmd": "ping"})
+                    reply = recvjson(stream)
+                    received = time.time()
+                    delay = received - sent
+                    if best is None or delay < best[1]:
+                        best = (reply["time"] - (sent + received) / 2., delay)
+            finally:
+                stream.close()
+                conn.close()
+            return {"status": "ok", "offset": best[0], "delay": best[1]}
+
+        results = self._all(offset)
+        for agent, result in results.items():
+            if result["status"] == "ok":
+                self.offsets[agent] = result["offset"]
+                lineprint("Agent "+agent[0]+":"+str(agent[1])+" clock offset "+\
+                          str(round(result["offset"]*1000, 2))+"ms (round trip "+\
+                          str(round(result["delay"]*1000, 2))+"ms)..")
+            else:
+                lineprint("Agent "+agent[0]+":"+str(agent[1])+" unreachable: "+\
+                          str(result.get("message"))+"..")
+
+        return results
+
+
+    def arm(self, configfile = None):
+
+        """Tells all agents to set up and warm up their camera"""
+
+        results = self._all(lambda a: self._send(a, {"cmd": "arm",
+                                                     "configfile": configfile}))
+        for agent, result in results.items():
+            if result["status"] != "ok":
+                lineprint("Agent "+agent[0]+":"+str(agent[1])+" not armed: "+\
+                          str(result.get("message"))+"..")
+
+        return results
+
+
+    def start(self, delay = 2):
+
+        """Tells all agents to start recording delay seconds from now and
+        returns the start offset reported by each agent"""
+
+        at = time.time() + delay
+        results = self._all(lambda a: self._send(a, {"cmd": "start",
+                            "at": at + self.offsets.get(a, 0.)},
+                            timeout = delay + 60))
+        for agent, result in results.items():
+            if result["status"] == "ok":
+                lineprint("Agent "+agent[0]+":"+str(agent[1])+" started "+\
+                          str(round(result["offset"]*1000, 2))+"ms from the "+\
+                          "shared start time..")
+            else:
+                lineprint("Agent "+agent[0]+":"+str(agent[1])+" did not start: "+\
+                          str(result.get("message"))+"..")
+
+        return results
+
+
+    def record(self, configfile = None, delay = 2):
+
+        """Runs the handshake, arms all agents and starts recording"""
+
+        self.handshake()
+        self.arm(configfile)
+
+        return self.start(delay)
+
+
+def snc():
+
+    """To run a sync agent or coordinate a synchronised recording from the
+    command line"""
+
+    parser = argparse.ArgumentParser(prog="recsync",
+             description="Synchronised recording start across multiple pis")
+    parser.add_argument("mode", choices=["agent","start"])
+    parser.add_argument("-c","--configfile", default=None, metavar="")
+    parser.add_argument("-p","--port", default=5005, type=int, metavar="")
+    parser.add_argument("-a","--agents", default="", metavar="",
+                        help="comma-separated list of host:port agents")
+    parser.add_argument("-d","--delay", default=2, type=float, metavar="")
+
+    args = parser.parse_args()
+    if args.mode == "agent":
+        if not isrpi():
+            lineprint("PiRecorder only works on a raspberry pi. Exiting..")
+            return
+        SyncAgent(configfile = args.configfile or "pirecorder.conf",
+                  port = args.port).run()
+    else:
+        agents = [a for a in args.agents.split(",") if a]
+        SyncCoordinator(agents).record(args.configfile, args.delay)
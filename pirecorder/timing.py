@@ -0,0 +1,187 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2020 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import numpy as np
+
+from time import sleep, monotonic, time
+from datetime import datetime, date
+
+def sleepuntil(deadline):
+
+    """Sleeps until the provided deadline on the monotonic clock"""
+
+    remaining = deadline - monotonic()
+    while remaining > 0:
+        sleep(remaining)
+        remaining = deadline - monotonic()
+
+
+def waituntil(deadline, spin = 0.005):
+
+    """Waits until the provided deadline on the monotonic clock with sub-
+    millisecond precision, by sleeping until spin seconds before the deadline
+    and busy-waiting for the remainder"""
+
+    sleepuntil(deadline - spin)
+    while monotonic() < deadline:
+        pass
+
+
+def todeadline(at):
+
+    """
+    Converts a wall-clock start time to a deadline on the monotonic clock, so
+    that waiting for it is not affected by later changes of the system clock.
+    The start time can be a unix timestamp, a datetime, or a string with a
+    unix timestamp, an iso date and time such as "2020-05-01 10:30:00.5" or
+    only a time such as "10:30:00.5" for today
+    """
+
+    if isinstance(at, str):
+        try:
+            at = float(at)
+        except ValueError:
+            pass
+    if isinstance(at, str):
+        if ":" in at and "-" not in at:
+            at = date.today().isoformat()+" "+at
+        at = datetime.fromisoformat(at)
+    if isinstance(at, datetime):
+        at = at.timestamp()
+
+    return monotonic() + (float(at) - time())
+
+
+def jitterstats(planned, actual):
+
+    """Returns the mean, 99th percentile and max jitter in milliseconds"""
+
+    jitter = (np.asarray(actual) - np.asarray(planned)) * 1000.
+    if len(jitter) == 0:
+        return {"mean": 0., "p99": 0., "max": 0.}
+    return {"mean": round(float(np.mean(jitter)),3),
+            "p99": round(float(np.percentile(jitter, 99)),3),
+            "max": round(float(np.max(jitter)),3)}
+
+
+class DeadlineTimer:
+
+    """
+    Drift-free timer that triggers events at absolute deadlines on the
+    monotonic clock, i.e. at start + slot * interval, so that the time it takes
+    to process an event does not push back later events and wall-clock
+    changes do not affect the spacing.
+
+    Parameters
+    ----------
+    interval : float
+        Time in seconds between subsequent deadlines.
+    overrun : ["skip", "catchup"], default = "skip"
+        What to do when an event takes longer than the interval. With "skip"
+        the slots that have passed are skipped and the next event is triggered
+        at the first upcoming deadline. With "catchup" the passed slots are
+        triggered immediately one after the other until the timer is back on
+        schedule.
+    logfile : str, default = None
+        Optional sidecar file to which the planned and actual time of each
+        event is written, followed by the jitter statistics when closed.
+    """
+
+    def __init__(self, interval, overrun = "skip", logfile = None):
+
+        assert overrun in ["skip", "catchup"], "overrun should be skip or catchup"
+        self.interval = float(interval)
+        self.overrun = overrun
+        self.start = None
+        self.slot = 0
+        self.count = 0
+        self.skipped = 0
+        self.planned = []
+        self.actual = []
+
+        self.logfile = None
+        if logfile is not None:
+            self.logfile = open(logfile, "w")
+            self.logfile.write("frame,slot,planned,actual,jitter_ms,walltime\n")
+
+
+    def deadline(self, slot = None):
+
+        """Returns the monotonic deadline of a slot, by default the next one"""
+
+        slot = self.slot if slot is None else slot
+        return self.start + slot * self.interval
+
+
+    def wait(self):
+
+        """Waits until the deadline of the next slot and returns the slot nr"""
+
+        if self.start is None:
+            self.start = monotonic()
+        sleepuntil(self.deadline())
+        now = monotonic()
+        self.planned.append(self.deadline() - self.start)
+        self.actual.append(now - self.start)
+        if self.logfile is not None:
+            jitter = (self.actual[-1] - self.planned[-1]) * 1000.
+            self.logfile.write("%d,%d,%.6f,%.6f,%.3f,%s\n" % (self.count,
+                               self.slot, self.planned[-1], self.actual[-1],
+                               jitter, datetime.now().isoformat()))
+        self.count += 1
+
+        return self.slot
+
+
+    def done(self):
+
+        """Moves the timer to the next slot after an event has finished and
+        returns the time in seconds until its deadline"""
+
+        self.slot += 1
+        if self.overrun == "skip":
+            late = int((monotonic() - self.deadline()) // self.interval) + 1
+            if late > 0:
+                self.slot += late
+                self.skipped += late
+
+        return max(0, self.deadline() - monotonic())
+
+
+    def stats(self):
+
+        """Returns the jitter statistics of all events so far"""
+
+        stats = jitterstats(self.planned, self.actual)
+        stats["frames"] = self.count
+        stats["skipped"] = self.skipped
+
+        return stats
+
+
+    def close(self):
+
+        """Writes the jitter statistics to the sidecar file and closes it"""
+
+        stats = self.stats()
+        if self.logfile is not None:
+            for key in ["frames", "skipped", "mean", "p99", "max"]:
+                self.logfile.write("# %s = %s\n" % (key, stats[key]))
+            self.logfile.close()
+            self.logfile = None
+
+        return stats
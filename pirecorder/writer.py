@@ -0,0 +1,225 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2020 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import os
+import shutil
+import numpy as np
+
+from io import BytesIO
+from pythutils.sysutils import lineprint
+from time import sleep, monotonic
+from threading import Thread
+
+def jpegsize(dims, quality = 85):
+
+    """Returns an estimate of the size in bytes of a camera jpeg image with
+    dims (width, height) at quality, to preallocate image buffers with"""
+
+    return int(dims[0] * dims[1] * (0.1 + 0.5 * (quality / 100.) ** 2))
+
+
+class WriteQueue:
+
+    """
+    Write-behind queue for captured images that keeps a bounded pool of
+    preallocated in-memory buffers. The capture loop takes a free buffer with
+    get(), captures into it, and hands it back with put() together with the
+    filename, after which a pool of background threads writes it to disk and
+    returns it to the pool, so that slow storage does not delay the capture.
+
+    Parameters
+    ----------
+    maxsize : int, default = 16
+        The number of buffers, i.e. the maximum number of images that can be
+        waiting to be written.
+    policy : ["block", "dropoldest", "spill"], default = "block"
+        What to do when all buffers are in use. With "block" get() waits until
+        a buffer is written, with "dropoldest" the oldest image still waiting
+        to be written is dropped, and with "spill" the oldest waiting image is
+        written to the spill directory, which should be a fast memory-backed
+        tmpfs, and moved to its final location when the writers catch up.
+        Images that fail to be written are logged and counted as failed, and
+        their buffers are returned to the pool.
+    workers : int, default = 2
+        The number of writer threads.
+    spilldir : str, default = "/dev/shm"
+        The directory used for spilling images with the "spill" policy.
+    bufsize : int, default = 4000000
+        The number of bytes to preallocate for each buffer, e.g. estimated
+        with jpegsize(). Buffers grow when an image is larger.
+    """
+
+    def __init__(self, maxsize = 16, policy = "block", workers = 2,
+                 spilldir = "/dev/shm", bufsize = 4000000):
+
+        assert policy in ["block","dropoldest","spill"], "unknown write policy"
+        self.policy = policy
+        self.spilldir = spilldir
+
+        self.free = queue.Queue()
+        for _ in range(int(maxsize)):
+            self.free.put(BytesIO(bytes(bufsize)))
+        self.todo = queue.Queue()
+        self.spilled = queue.Queue()
+
+        self.written = 0
+        self.nrbytes = 0
+        self.dropped = 0
+        self.nrspilled = 0
+        self.failed = []
+        self.latencies = []
+
+        self.threads = [Thread(target = self._write) for _ in range(workers)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+
+    def get(self):
+
+        """Returns an empty buffer, applying the policy if none is free"""
+
+        try:
+            buf = self.free.get_nowait()
+        except queue.Empty:
+            buf = None
+            if self.policy in ["dropoldest","spill"]:
+                try:
+                    oldest = self.todo.get_nowait()
+                except queue.Empty:
+                    oldest = None
+                if oldest is not None:
+                    buf = oldest[0]
+                    if self.policy == "dropoldest":
+                        self.dropped += 1
+                    else:
+                        self._spill(*oldest)
+            if buf is None:
+                buf = self.free.get()
+        buf.seek(0)
+
+        return buf
+
+
+    def put(self, buf, filename):
+
+        """Queues a filled buffer to be written to filename"""
+
+        self.todo.put((buf, filename, buf.tell(), monotonic()))
+
+
+    def _spill(self, buf, filename, size, queued):
+
+        spillfile = os.path.join(self.spilldir, os.path.basename(filename))
+        try:
+            with buf.getbuffer() as view, open(spillfile, "wb") as f:
+                f.write(view[:size])
+        except Exception as e:
+            self._failed(filename, e)
+            return
+        self.nrspilled += 1
+        self.spilled.put((spillfile, filename, queued))
+
+
+    def _write(self):
+
+        while True:
+            try:
+                item = self.todo.get(timeout = 0.1)
+            except queue.Empty:
+                try:
+                    spillfile, filename, queued = self.spilled.get_nowait()
+                except queue.Empty:
+                    continue
+                try:
+                    start = monotonic()
+                    size = os.path.getsize(spillfile)
+                    shutil.move(spillfile, filename)
+                    self._done(filename, queued, start, size)
+                except Exception as e:
+                    self._failed(filename, e)
+                continue
+            if item is None:
+                break
+            buf, filename, size, queued = item
+            try:
+                start = monotonic()
+                with buf.getbuffer() as view, open(filename, "wb") as f:
+                    f.write(view[:size])
+                self._done(filename, queued, start, size)
+            except Exception as e:
+                self._failed(filename, e)
+            finally:
+                self.free.put(buf)
+
+
+    def _done(self, filename, queued, start, size):
+
+        now = monotonic()
+        self.latencies.append((filename, now-start, now-queued))
+        self.written += 1
+        self.nrbytes += size
+
+
+    def _failed(self, filename, error):
+
+        self.failed.append((filename, error))
+        lineprint("Writing "+filename+" failed: %r.." % (error,))
+
+
+    def stats(self):
+
+        """Returns the number of written, dropped, spilled, and failed images,
+        the number of bytes written, and the mean and max write time and latency
+        from queueing to written in ms"""
+
+        times = np.array([l[1:] for l in self.latencies]).reshape(-1,2)*1000.
+        stats = {"written": self.written, "bytes": self.nrbytes,
+                 "dropped": self.dropped, "spilled": self.nrspilled,
+                 "failed": len(self.failed)}
+        for i, key in enumerate(["write", "latency"]):
+            vals = times[:,i] if len(times) > 0 else [0.]
+            stats[key+"_mean"] = round(float(np.mean(vals)),3)
+            stats[key+"_max"] = round(float(np.max(vals)),3)
+
+        return stats
+
+
+    def close(self, logfile = None):
+
+        """Waits until all images are written, stops the writers and
+        optionally writes the per-file write time and latency to logfile"""
+
+        while not self.todo.empty() or not self.spilled.empty():
+            sleep(0.05)
+        for _ in self.threads:
+            self.todo.put(None)
+        for thread in self.threads:
+            thread.join()
+        if logfile is not None:
+            with open(logfile, "w") as f:
+                f.write("file,write_ms,latency_ms\n")
+                for filename, write, latency in self.latencies:
+                    f.write("%s,%.3f,%.3f\n" % (os.path.basename(filename),
+                            write*1000., latency*1000.))
+
+        return self.stats()
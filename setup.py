@@ -50,16 +50,16 @@ if __name__ == "__main__":
                             "cron-descriptor",
                             "pyyaml",
                             "future",
-                            "numpy==1.16.5; python_version>='2' and python_version<'3'",
-                            "numpy; python_version>='3'",
-                            "localconfig==0.4.2; python_version>='2' and python_version<'3'",
-                            "localconfig==1.1.1; python_version>='3'"],
+                            "numpy"],
+          python_requires=">=3.7",
           entry_points={"console_scripts": [
                             "stream = pirecorder.stream:strm",
                             "camconfig = pirecorder.camconfig:config",
                             "record = pirecorder.pirecorder:rec",
                             "schedule = pirecorder.schedule:sch",
-                            "convert = pirecorder.convert:conv"],},
+                            "convert = pirecorder.convert:conv",
+                            "recdaemon = pirecorder.daemon:dmn",
+                            "recsync = pirecorder.sync:snc"],},
           download_url=DOWNLOAD_URL,
           version=__version__,
           license="License :: OSI Approved :: Apache Software License",
@@ -68,8 +68,8 @@ if __name__ == "__main__":
           include_package_data=True,
           classifiers=[
                      "Intended Audience :: Science/Research",
-                     "Programming Language :: Python :: 2.7",
                      "Programming Language :: Python :: 3",
+                     "Programming Language :: Python :: 3 :: Only",
                      "License :: OSI Approved :: Apache Software License",
                      "Topic :: Scientific/Engineering :: Visualization",
                      "Topic :: Scientific/Engineering :: Image Recognition",
@@ -26,6 +26,22 @@ import pirecorder
 time.sleep(1)
 print("DONE..\n")
 
+# Startup benchmark: import time of each entry point against a budget
+print("TEST: startup time of the command line entry points")
+import sys
+import subprocess
+budget = {"pirecorder": 0.2, "pirecorder.pirecorder": 1.5,
+          "pirecorder.schedule": 1.5, "pirecorder.daemon": 0.5}
+heavy = ["cv2", "seaborn", "crontab", "multiprocess"]
+for module, seconds in budget.items():
+    code = "import sys, time; t = time.time(); import "+module+"; "+\
+           "print(time.time()-t, [m for m in "+str(heavy)+" if m in sys.modules])"
+    out = subprocess.check_output([sys.executable, "-c", code]).decode().split(" ", 1)
+    print(module+" imported in "+str(round(float(out[0]), 3))+"s (budget "+\
+          str(seconds)+"s), within budget: "+str(float(out[0]) < seconds)+\
+          ", heavy modules: "+out[1].strip())
+print("DONE..\n")
+
 # Initialise PiRecorder class with default configfile
 ## Sets up the pirecorder directory, creates configfile, stores settings
 print("TEST: initialise PiRecorder class")
@@ -51,10 +67,67 @@ rec.settings(recdir = "TESTS", label = "TEST", rectype = "img", subdirs = False,
 time.sleep(1)
 print("DONE..\n")
 
+# Batch settings in a single transaction that writes the file once
+print("TEST: settings transaction with a single atomic write")
+mtime = os.path.getmtime(rec.configfile)
+rec.settings(internal = True)
+print("Unchanged settings not written: "+str(os.path.getmtime(rec.configfile) == mtime))
+with rec.transaction():
+    rec.settings(vidduration = 20, viddelay = 5)
+    rec.settings(vidduration = 10, viddelay = 0)
+print("DONE..\n")
+
+# Microbenchmark of loading the configuration cold and from its snapshot
+print("TEST: cold and warm configuration load times")
+from pirecorder import config
+os.utime(rec.configfile)
+config._snapshots.clear()
+start = time.perf_counter()
+config.Config(rec.configfile)
+print("Cold load: "+str(round((time.perf_counter()-start)*1000, 3))+"ms")
+start = time.perf_counter()
+for _ in range(100):
+    config._snapshots.clear()
+    config.Config(rec.configfile)
+print("Warm load from snapshot: "+str(round((time.perf_counter()-start)*10, 3))+"ms")
+start = time.perf_counter()
+for _ in range(100):
+    config.Config(rec.configfile)
+print("Warm load in process: "+str(round((time.perf_counter()-start)*10, 3))+"ms")
+print("DONE..\n")
+
+# Camera warm-up until the exposure and white balance converge
+print("TEST: setting the camera warm-up to wait until converged")
+rec.settings(warmup = "converge")
+time.sleep(1)
+print("DONE..\n")
+
+# Storage preflight: cold benchmark and warm cached check of recdir
+print("TEST: storage preflight of recording directory")
+for run in ["cold", "warm"]:
+    start = time.time()
+    check = pirecorder.storage.preflight("/home/pi/TESTS", rec.config,
+                                         "/home/pi/TESTS/storage.yml")
+    print(run+" preflight took "+str(round(time.time()-start, 3))+"s: "+str(check))
+rec.settings(preflight = "warn")
+print("DONE..\n")
+
 # Automatically get the configuration Settings
 print("TEST: running auto configuration (shutterspeed and whitebalance)")
 print("Before: shutterspeed = " + str(rec.config.cam.shutterspeed) + "; gains = " + str(rec.config.cus.gains))
 rec.autoconfig()
+print("After: shutterspeed = " + str(rec.config.cam.shutterspeed) + "; gains = " + str(rec.config.cus.gains))
+print("Calibration took "+str(round(rec.calibtime, 2))+"s")
+time.sleep(1)
+print("DONE..\n")
+
+print("TEST: recalibrating an open camera in between recordings")
+rec.settings(rectype = "img")
+rec.autoconfig(keepopen = True)
+rec.record(keepopen = True)
+rec.autoconfig()
+print("Recalibration took "+str(round(rec.calibtime, 2))+"s")
+rec.close()
 time.sleep(1)
 print("DONE..\n")
 
@@ -70,10 +143,54 @@ rec.settings(rectype = "imgseq", imgnr = 10, imgtime = 60, imgwait = 5,
 rec.record()
 print("DONE..\n")
 
+# Test recording 2b: a drift-free sequence with a timing sidecar file
+print("TEST: recording a sequence of 20 images, 1s apart, with timing file")
+rec.settings(rectype = "imgseq", imgnr = 20, imgtime = 60, imgwait = 1,
+             overrun = "skip", writequeue = 4, writepolicy = "spill",
+             subdirs = True)
+rec.record()
+print("DONE..\n")
+
+# Test recording 2c: a sequence of long exposures
+print("TEST: recording a sequence of 5 long exposures of 2s, 2.2s apart")
+rec.settings(rectype = "imgseq", automode = False, shutterspeed = 2000000,
+             imgwait = 2.2, imgnr = 5, imgtime = 60)
+start = time.time()
+rec.record()
+print("Recorded 5 long exposures in "+str(round(time.time()-start,2))+"s")
+rec.settings(automode = True, shutterspeed = 8000)
+time.sleep(1)
+print("DONE..\n")
+
+# Test recording 2d: a burst sequence through the video port
+print("TEST: recording a burst sequence of 100 images at 10 images/s")
+rec.settings(rectype = "imgseq", imgnr = 100, imgtime = 10, imgwait = 0.1,
+             burst = True, subdirs = True)
+rec.record()
+rec.settings(burst = False)
+print("DONE..\n")
+
+# Test recording: unencoded frames, benchmarked against the jpeg path
+print("TEST: recording 100 raw grayscale frames and 100 jpegs at 10 images/s")
+rec.settings(rectype = "imgraw", rawformat = "gray", imgdims = (1640, 1232),
+             imgwait = 0.1, imgnr = 100, imgtime = 10, burst = True)
+for rectype in ["imgraw", "imgseq"]:
+    rec.settings(rectype = rectype)
+    start = time.time()
+    rec.record()
+    print(rectype+" took "+str(round(time.time()-start, 2))+"s")
+rawfile = sorted(listfiles("/home/pi/TESTS", ".npy", keepdir = True))[-1]
+print("Raw frames: "+str(pirecorder.rawarray.readraw(rawfile).shape))
+rec.settings(burst = False, imgdims = (2592, 1944))
+print("DONE..\n")
+
 # Test recording 3: a single 10s video
 print("TEST: recording a 10s video")
-rec.settings(rectype = "vid", vidduration = 10, viddelay = 0, subdirs = False)
+rec.settings(rectype = "vid", vidduration = 10, viddelay = 0, subdirs = False,
+             frametimes = True)
 rec.record()
+framefile = sorted(listfiles("/home/pi/TESTS", ".bin", keepdir = True))[-1]
+print(pirecorder.frames.framestats(pirecorder.frames.readframes(framefile)))
 print("DONE..\n")
 
 # Test recording 4: a sequence of videos
@@ -83,6 +200,124 @@ rec.record()
 time.sleep(1)
 print("DONE..\n")
 
+# Test recording 5: a gapless segmented video
+print("TEST: recording a 30s video in 10s segments without gaps")
+rec.settings(rectype = "vidseq", vidduration = 30, viddelay = 0, vidsegment = 10)
+rec.record()
+manifest = sorted(f for f in listfiles("/home/pi/TESTS", ".csv", keepdir = True)
+                  if f.endswith("_segments.csv"))[-1]
+rows = [l.strip().split(",") for l in open(manifest).readlines()[1:]]
+for prev, row in zip(rows[:-1], rows[1:]):
+    print("Segment "+row[0]+" continuous: "+str(int(row[3]) == int(prev[4])+1))
+rec.settings(vidsegment = 0)
+time.sleep(1)
+print("DONE..\n")
+
+# Test recording 6: motion-triggered videos
+print("TEST: watching 60s for motion, wave in front of the camera")
+rec.settings(rectype = "vidmotion", vidduration = 60, viddelay = 0,
+             motionpre = 5, motionpost = 5, motionthresh = 0.01)
+rec.record()
+time.sleep(1)
+print("DONE..\n")
+
+# Test recording 7: motion activity from the encoder's motion vectors
+print("TEST: recording a 10s video with motion activity time series")
+rec.settings(rectype = "vid", vidduration = 10, viddelay = 0,
+             motionvectors = True)
+rec.record()
+motionfile = sorted(listfiles("/home/pi/TESTS", ".bin", keepdir = True))[-1]
+activity = pirecorder.motion.readmotion(motionfile)
+print(str(len(activity))+" frames, mean activity "+str(activity["activity"].mean()))
+rec.settings(motionvectors = False)
+time.sleep(1)
+print("DONE..\n")
+
+# Test recording 8: streaming video directly into an mp4 container
+print("TEST: recording a 10s video directly to mp4")
+rec.settings(rectype = "vid", vidduration = 10, viddelay = 0, vidformat = "mp4")
+rec.record()
+mp4file = sorted(listfiles("/home/pi/TESTS", ".mp4", keepdir = True))[-1]
+print(mp4file+" exists: "+str(os.path.isfile(mp4file)))
+import cv2
+output = pirecorder.frames.Mp4Output("/home/pi/TESTS/remuxed.mp4", 24)
+with open(framefile.replace("_frames.bin", ".h264"), "rb") as f:
+    output.write(f.read())
+output.close()
+nrframes = cv2.VideoCapture("/home/pi/TESTS/remuxed.mp4").get(cv2.CAP_PROP_FRAME_COUNT)
+print("Remuxed frames match: "+str(int(nrframes) == len(pirecorder.frames.readframes(framefile))))
+rec.settings(vidformat = "h264")
+time.sleep(1)
+print("DONE..\n")
+
+# Test recording 9: low-resolution preview alongside the recording
+print("TEST: recording a 10s video with a simultaneous preview")
+rec.settings(rectype = "vid", vidduration = 10, viddelay = 0, preview = "bgr",
+             previewdims = (320, 240))
+rec.record()
+print("Preview frame shape: "+str(rec.preview.read().shape))
+rec.settings(preview = None)
+time.sleep(1)
+print("DONE..\n")
+
+# Background offload to a local directory standing in for a NAS
+print("TEST: recording a 5s video and offloading it to another directory")
+rec.settings(rectype = "vid", vidduration = 5, viddelay = 0,
+             offload = "/home/pi/TESTS/offloaded", offloadrate = 2)
+os.makedirs("/home/pi/TESTS/offloaded", exist_ok = True)
+rec.record()
+print("All files offloaded: "+str(rec.offloader.wait()))
+print(os.listdir("/home/pi/TESTS/offloaded"))
+rec.settings(offload = None)
+time.sleep(1)
+print("DONE..\n")
+
+print("TEST: recording a 10s video with an alert when over 1% of frames drop")
+rec.settings(rectype = "vid", vidduration = 10, viddelay = 0,
+             dropthresh = 0.01, dropaction = "alert")
+rec.record()
+rec.settings(dropthresh = 0)
+time.sleep(1)
+print("DONE..\n")
+
+# Recording metrics
+print("TEST: recording a 10s video with metrics in json and prometheus format")
+import json
+rec.settings(rectype = "vid", vidduration = 10, viddelay = 0,
+             promfile = "/home/pi/TESTS/pirecorder.prom")
+rec.record()
+with open("/home/pi/TESTS/"+rec.filebase+"_metrics.json") as f:
+    metrics = json.load(f)
+print({k: metrics[k] for k in ["frames", "expected", "dropped", "bitrate",
+                               "write_max", "cpu_percent", "maxrss"]})
+rec.settings(promfile = None)
+time.sleep(1)
+print("DONE..\n")
+
+# Recording start at an absolute time
+print("TEST: recording a 5s video starting precisely 10s from now")
+rec.settings(rectype = "vid", vidduration = 5, viddelay = 0)
+rec.record(start_at = time.time() + 10)
+print("Start error: "+str(round(rec.starterror*1000, 3))+"ms")
+assert abs(rec.starterror) < 0.05, "start error should be under 50ms"
+time.sleep(1)
+print("DONE..\n")
+
+# Synchronised recording start with a single agent on localhost
+print("TEST: synchronised recording start with an agent on localhost")
+from threading import Thread
+rec.settings(rectype = "vid", vidduration = 5, viddelay = 0)
+agent = pirecorder.SyncAgent(configfile = "test.conf", port = 0,
+                             host = "127.0.0.1", logging = False)
+thread = Thread(target = agent.run)
+thread.start()
+time.sleep(1)
+sync = pirecorder.SyncCoordinator(["127.0.0.1:"+str(agent.port)])
+print(sync.record(delay = 2))
+agent.stopped = True
+thread.join()
+print("DONE..\n")
+
 # Run video stream
 print("TEST: run video stream")
 print("Function records mouse clicks and movements and responds to keypresses:")
@@ -130,6 +365,17 @@ rec.schedule(jobname = "rec1", delete = "job")
 time.sleep(1)
 print("DONE..\n")
 
+# Recorder daemon tests
+print("TEST: Recorder daemon - record with a warm camera")
+from threading import Thread
+daemon = pirecorder.RecDaemon(configfile = "test.conf", logging = False)
+Thread(target = daemon.run).start()
+time.sleep(2)
+pirecorder.recclient("test.conf")
+pirecorder.recclient("test.conf", cmd = "stop")
+time.sleep(1)
+print("DONE..\n")
+
 # Converting media
 print("TEST: Converting media - folder of image sequence to video")
 imagedir = listfiles(dir = "/home/pi/TESTS", type = "dir", keepdir = True)[0]
@@ -0,0 +1,586 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2020 - 2020 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+# Tests that run without a camera, either with pytest or as a script
+
+import os
+import sys
+import time
+import types
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+
+from pirecorder.camutils import converge
+from pirecorder.timing import todeadline, waituntil
+from pirecorder.sync import SyncAgent, SyncCoordinator
+from pirecorder.frames import FrameOutput, SyntheticFrames, readframes, KEYFRAME
+from pirecorder.frames import Mp4Output
+from pirecorder.writer import WriteQueue
+from pirecorder.daemon import RecDaemon, recclient
+from pirecorder.liveview import LiveView, SyntheticSource
+from pirecorder.convert import Convert, runffmpeg
+from pirecorder.motion import MotionVectors, TriggerOutput, motionseries, readmotion
+
+# Motion vectors of 40 frames of a 160x128 video, with a small moving object
+# in frames 10-19 and a large one in frames 30-34
+MOTIONFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data",
+                          "motion.npy")
+
+# Raw H.264 stream of 72 frames at 24 fps
+H264FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data",
+                        "canned.h264")
+
+
+class _FakeRecorder:
+
+    """Stands in for PiRecorder in a SyncAgent, starting at start_at"""
+
+    def __init__(self):
+
+        self.cam = self
+        self.closed = False
+        self.starterror = None
+        self.started = None
+
+
+    def record(self, keepopen = False, start_at = None):
+
+        deadline = todeadline(start_at)
+        waituntil(deadline)
+        self.started = time.time()
+        self.starterror = time.monotonic() - deadline
+
+
+    def close(self):
+
+        self.closed = True
+
+
+class _StubCam:
+
+    """Stands in for a camera whose exposure settles after settle polls"""
+
+    analog_gain, digital_gain, awb_gains = 1.0, 1.0, (1.5, 1.8)
+
+    def __init__(self, settle = 5):
+
+        self.polls = 0
+        self.settle = settle
+
+
+    @property
+    def exposure_speed(self):
+
+        self.polls += 1
+        return 10000 + max(0, self.settle-self.polls)*2000
+
+
+def test_converge():
+
+    cam = _StubCam(settle = 5)
+    converged, _, polls = converge(cam, stable = 3, interval = 0.01,
+                                   timeout = 5)
+    assert converged
+    assert polls == cam.polls == cam.settle + 3
+
+
+def test_todeadline():
+
+    from datetime import datetime
+
+    at = time.time() + 100
+    stamp = datetime.fromtimestamp(at)
+    deadlines = [todeadline(at), todeadline(str(at)), todeadline(stamp),
+                 todeadline(stamp.isoformat(" "))]
+    if stamp.date() == datetime.now().date():
+        deadlines.append(todeadline(stamp.time().isoformat()))
+    assert max(deadlines) - min(deadlines) < 0.01
+    assert abs(deadlines[0] - time.monotonic() - 100) < 0.01
+
+
+def test_sync_start():
+
+    agents = []
+    for _ in range(2):
+        agent = SyncAgent(port = 0, host = "127.0.0.1", logging = False)
+        agent.rec = _FakeRecorder()
+        thread = threading.Thread(target = agent.run, daemon = True)
+        thread.start()
+        agents.append(agent)
+    while not all(getattr(a, "server", None) and a.port for a in agents):
+        time.sleep(0.01)
+
+    sync = SyncCoordinator([("127.0.0.1", a.port) for a in agents], pings = 20)
+    try:
+        handshake = sync.handshake()
+        assert all(r["status"] == "ok" for r in handshake.values())
+        assert all(abs(r["offset"]) < 0.005 for r in handshake.values())
+        results = sync.start(delay = 0.5)
+        assert all(r["status"] == "ok" for r in results.values())
+        started = [a.rec.started for a in agents]
+        assert max(started) - min(started) < 0.005
+    finally:
+        for agent in agents:
+            sync._send(("127.0.0.1", agent.port), {"cmd": "stop"})
+
+
+class _SplitCamera(SyntheticFrames):
+
+    """Stands in for a camera that is asked to split the recording to a new
+    segment every splitevery frames, which like split_recording switches to
+    the new output at the next keyframe"""
+
+    def __init__(self, segment, splitevery, fps = 10):
+
+        SyntheticFrames.__init__(self, fps = fps)
+        self.segment = segment
+        self.splitevery = splitevery
+        self.output = segment(self)
+        self.pending = None
+
+
+    def write(self, buf):
+
+        if self.frame.index and self.frame.index % self.splitevery == 0:
+            self.pending = self.segment(self)
+        if self.pending is not None and self.frame.frame_type == KEYFRAME:
+            self.output, self.pending = self.pending, None
+
+        return self.output.write(buf)
+
+
+def test_segment_continuity():
+
+    tmpdir = tempfile.mkdtemp()
+    outputs = []
+
+    def segment(camera):
+        filename = os.path.join(tmpdir, "S%02d.h264" % (len(outputs)+1))
+        outputs.append(FrameOutput(camera, filename, filename+".frames"))
+        return outputs[-1]
+
+    try:
+        total = 103
+        cam = _SplitCamera(segment, splitevery = 13, fps = 10)
+        cam.play(cam, total)
+        for output in outputs:
+            output.close()
+
+        assert len(outputs) == 8
+        assert sum(o.frames for o in outputs) == total
+        assert outputs[0].first == 0 and outputs[-1].last == total - 1
+        for prev, output in zip(outputs, outputs[1:]):
+            assert output.first == prev.last + 1
+            assert output.first % 10 == 0
+        assert all(o.dropped == 0 for o in outputs)
+        index = np.concatenate([readframes(o.filename+".frames")["index"]
+                                for o in outputs])
+        assert (index == np.arange(total)).all()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_dropped_frames():
+
+    tmpdir = tempfile.mkdtemp()
+
+    try:
+        frames = SyntheticFrames(fps = 24, gaps = {10: 2, 50: 5})
+        output = FrameOutput(frames, os.path.join(tmpdir, "gaps.h264"))
+        frames.play(output, 100)
+        output.close()
+
+        assert output.frames == 100 and output.dropped == 7
+        assert [g[:3] for g in output.gaps] == [(10, 500000, 2), (50, 2375000, 5)]
+        assert [g[3] for g in output.gaps] == [125000, 250000]
+        assert output.newgaps() == output.gaps and output.newgaps() == []
+        assert np.isclose(output.dropfraction(), 7 / 107.)
+        assert output.summary() == "100 frames, 7 dropped (6.54%) in 2 gaps, "+\
+                                   "largest 250ms"
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_motion_offline():
+
+    tmpdir = tempfile.mkdtemp()
+    vectors = np.load(MOTIONFILE)
+    datafile = os.path.join(tmpdir, "motion.data")
+    vectors.tofile(datafile)
+
+    try:
+        series = motionseries(datafile, (160, 128), datafile+".bin")
+        assert (series == readmotion(datafile+".bin")).all()
+        assert (series["frame"] == np.arange(40)).all()
+        expected = np.zeros(40)
+        expected[10:20] = 9 / 80.
+        expected[30:35] = 48 / 80.
+        assert np.allclose(series["activity"], expected)
+
+        moving = np.flatnonzero(series["activity"] > 0.05)
+        assert list(moving) == list(range(10, 20)) + list(range(30, 35))
+        assert list(np.flatnonzero(series["activity"] > 0.5)) == list(range(30, 35))
+
+        output = MotionVectors((160, 128), threshold = 2)
+        data = vectors.tobytes()
+        for i in range(0, len(data), 1000):
+            output.write(data[i:i+1000])
+            if i == 9000:
+                assert np.isclose(output.peak(), 9 / 80.)
+        assert output.frames == 40
+        assert np.isclose(output.peak(), 48 / 80.)
+        assert output.peak() == 0
+
+        trigger = TriggerOutput(os.path.join(tmpdir, "trigger.h264"))
+        trigger.write(b"post")
+        assert os.path.getsize(trigger.filename) == 0
+        trigger.file.write(b"pre")
+        trigger.release()
+        trigger.write(b"more")
+        trigger.close()
+        with open(trigger.filename, "rb") as f:
+            assert f.read() == b"prepostmore"
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _boxes(data, start = 0, end = None):
+
+    """Yields the type, start and end of the MP4 boxes in data"""
+
+    end = len(data) if end is None else end
+    while start + 8 <= end:
+        size = int.from_bytes(data[start:start+4], "big")
+        if size == 0:
+            size = end - start
+        if size < 8:
+            break
+        yield data[start+4:start+8].decode(), start + 8, start + size
+        start += size
+
+
+def _mp4samples(filename):
+
+    """Returns the top-level box types of a fragmented MP4 file and the
+    number of samples in its fragments"""
+
+    with open(filename, "rb") as f:
+        data = f.read()
+    types, samples = [], 0
+    for box, start, end in _boxes(data):
+        types.append(box)
+        if box != "moof":
+            continue
+        for traf, tstart, tend in _boxes(data, start, end):
+            if traf != "traf":
+                continue
+            for trun, rstart, _ in _boxes(data, tstart, tend):
+                if trun == "trun":
+                    samples += int.from_bytes(data[rstart+4:rstart+8], "big")
+
+    return types, samples
+
+
+def _writestream(output, data, chunksize = 1000):
+
+    for i in range(0, len(data), chunksize):
+        output.write(data[i:i+chunksize])
+    output.close()
+
+
+def test_mp4_container():
+
+    tmpdir = tempfile.mkdtemp()
+    path = os.environ["PATH"]
+    with open(H264FILE, "rb") as f:
+        data = f.read()
+
+    try:
+        if shutil.which("ffmpeg") is not None:
+            output = Mp4Output(os.path.join(tmpdir, "video.mp4"), 24)
+            _writestream(output, data)
+            assert output.filename.endswith("video.mp4")
+            types, samples = _mp4samples(output.filename)
+            assert types[:2] == ["ftyp", "moov"] and "moof" in types
+            assert samples == 72
+            assert sorted(os.listdir(tmpdir)) == ["video.mp4"]
+
+        os.environ["PATH"] = tmpdir
+        output = Mp4Output(os.path.join(tmpdir, "missing.mp4"), 24)
+        _writestream(output, data)
+        assert output.filename == os.path.join(tmpdir, "missing.h264")
+        with open(output.filename, "rb") as f:
+            assert f.read() == data
+
+        ffmpeg = os.path.join(tmpdir, "ffmpeg")
+        with open(ffmpeg, "w") as f:
+            f.write("#!/bin/sh\nexit 1\n")
+        os.chmod(ffmpeg, 0o755)
+        output = Mp4Output(os.path.join(tmpdir, "stopped.mp4"), 24)
+        output.proc.wait()
+        _writestream(output, data)
+        assert output.filename == os.path.join(tmpdir, "stopped.h264")
+        with open(output.filename, "rb") as f:
+            assert f.read() == data
+    finally:
+        os.environ["PATH"] = path
+        shutil.rmtree(tmpdir)
+
+
+def test_write_errors():
+
+    tmpdir = tempfile.mkdtemp()
+    writer = WriteQueue(maxsize = 2, workers = 1, bufsize = 100)
+
+    try:
+        for i in range(6):
+            buf = writer.get()
+            buf.write(b"image")
+            folder = tmpdir if i % 2 else os.path.join(tmpdir, "missing")
+            writer.put(buf, os.path.join(folder, "img%d.jpg" % i))
+        stats = writer.close()
+        assert stats["written"] == 3 and stats["failed"] == 3
+        assert sorted(os.listdir(tmpdir)) == ["img1.jpg", "img3.jpg", "img5.jpg"]
+        assert writer.free.qsize() == 2
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _stubffmpeg(filename, status = 0):
+
+    """Writes a stub ffmpeg that reports 125 frames of progress, writes its
+    arguments to the output file and exits with status"""
+
+    with open(filename, "w") as f:
+        f.write("#!"+sys.executable+"\n"
+                "import sys, time\n"
+                "for i in range(1, 6):\n"
+                "    time.sleep(0.05)\n"
+                "    print('frame=%d\\nfps=25.0\\nprogress=continue' % (i*25), flush=True)\n"
+                "print('progress=end', flush=True)\n"
+                "if "+str(status)+":\n"
+                "    sys.exit('stub failed')\n"
+                "open(sys.argv[-1], 'w').write(' '.join(sys.argv[1:]))\n")
+    os.chmod(filename, 0o755)
+
+    return filename
+
+
+def test_convert_stub():
+
+    tmpdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    ffmpeg = _stubffmpeg(os.path.join(tmpdir, "ffmpeg"))
+    failing = _stubffmpeg(os.path.join(tmpdir, "failing"), status = 1)
+
+    try:
+        outfile = os.path.join(tmpdir, "out.mp4")
+        result = runffmpeg([ffmpeg, "-i", "in.h264", outfile], "in.h264", 125)
+        assert result["error"] is None and result["frames"] == 125
+        assert result["wall"] >= 0.25 and result["cpu"] > 0
+        with open(outfile) as f:
+            args = f.read().split()
+        assert args[:2] == ["-progress", "pipe:1"] and args[-1] == outfile
+
+        result = runffmpeg([failing, outfile], "in.h264")
+        assert result["error"] == "stub failed" and result["frames"] == 125
+        result = runffmpeg([os.path.join(tmpdir, "missing"), outfile], "in.h264")
+        assert result["error"].startswith("could not start")
+
+        indir = os.path.join(tmpdir, "videos")
+        os.makedirs(indir)
+        for name in ["a.h264", "b c.h264"]:
+            open(os.path.join(indir, name), "wb").close()
+        outdir = os.path.join(tmpdir, "converted")
+        Convert(indir = indir, outdir = outdir, pools = 2, ffmpeg = ffmpeg)
+        assert sorted(os.listdir(outdir)) == ["a.mp4", "b c.mp4"]
+        with open(os.path.join(outdir, "b c.mp4")) as f:
+            args = f.read()
+        assert "-i b c.h264 -vcodec copy" in args
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
+
+
+def test_liveview():
+
+    from urllib.request import urlopen
+
+    source = SyntheticSource((320, 240), fps = 24)
+    view = LiveView(source, port = 0, host = "127.0.0.1").start()
+    url = "http://127.0.0.1:"+str(view.port)
+
+    try:
+        snapshot = urlopen(url+"/snapshot.jpg", timeout = 5)
+        assert snapshot.headers["Content-Type"] == "image/jpeg"
+        assert snapshot.read()[:2] == b"\xff\xd8"
+        stream = urlopen(url+"/stream.mjpg", timeout = 5)
+        for _ in range(3):
+            assert stream.readline().strip() == b"--FRAME"
+            assert stream.readline().strip() == b"Content-Type: image/jpeg"
+            size = int(stream.readline().split(b":")[1])
+            stream.readline()
+            jpeg = stream.read(size)
+            assert jpeg[:2] == b"\xff\xd8" and jpeg[-2:] == b"\xff\xd9"
+            stream.readline()
+        stream.close()
+    finally:
+        view.stop()
+        source.close()
+
+
+class _FakePiCamera:
+
+    """Stands in for picamera.PiCamera, with a stable exposure and white
+    balance and capturing small jpeg files"""
+
+    opened = []
+
+    def __init__(self):
+
+        self.closed = False
+        self.resolution = (640, 480)
+        self.framerate = 1
+        self.exposure_speed = 10000
+        self.analog_gain = 1
+        self.digital_gain = 1
+        self.awb_gains = (1.5, 1.8)
+        _FakePiCamera.opened.append(self)
+
+
+    def capture(self, output, format = None, **kwargs):
+
+        with open(output, "wb") as f:
+            f.write(b"\xff\xd8")
+
+
+    def close(self):
+
+        self.closed = True
+
+
+def test_daemon():
+
+    import pirecorder.pirecorder as pirec
+
+    tmpdir = tempfile.mkdtemp()
+    cwd, home, isrpi = os.getcwd(), os.environ.get("HOME"), pirec.isrpi
+    picamera = types.ModuleType("picamera")
+    picamera.PiCamera = _FakePiCamera
+    sys.modules["picamera"] = picamera
+    pirec.isrpi = lambda: True
+    os.environ["HOME"] = tmpdir
+    socketfile = os.path.join(tmpdir, "recorder.sock")
+    del _FakePiCamera.opened[:]
+
+    try:
+        for configfile in ["one.conf", "two.conf"]:
+            rec = pirec.PiRecorder(configfile, logging = False)
+            rec.settings(rectype = "img", warmup = "converge", preflight = None,
+                         label = configfile[:3])
+        daemon = RecDaemon("one.conf", socketfile = socketfile, logging = False)
+        thread = threading.Thread(target = daemon.run, daemon = True)
+        thread.start()
+        while not os.path.exists(socketfile):
+            time.sleep(0.01)
+        assert len(_FakePiCamera.opened) == 1
+
+        def request(cmd = "record", configfile = "one.conf"):
+            return recclient(configfile, cmd, socketfile, fallback = False)
+
+        assert request()["status"] == "ok"
+        assert request()["status"] == "ok"
+        assert len(_FakePiCamera.opened) == 1
+        status = request("status")
+        assert status["configfile"] == "one.conf" and status["recordings"] == 2
+
+        configfile = os.path.join(tmpdir, "pirecorder", "one.conf")
+        os.utime(configfile, (time.time(), os.path.getmtime(configfile) + 1))
+        assert request()["status"] == "ok"
+        assert len(_FakePiCamera.opened) == 2
+        assert _FakePiCamera.opened[0].closed
+        assert request(configfile = "two.conf")["status"] == "ok"
+        assert len(_FakePiCamera.opened) == 3
+        assert request("status")["configfile"] == "two.conf"
+
+        recdir = os.path.join(tmpdir, "pirecorder", "recordings")
+        images = [f for f in os.listdir(recdir) if f.endswith(".jpg")]
+        assert set(f[:3] for f in images) == set(["one", "two"])
+
+        assert request("stop")["status"] == "ok"
+        thread.join(5)
+        assert not thread.is_alive()
+        assert _FakePiCamera.opened[-1].closed
+        assert not os.path.exists(socketfile)
+        assert request("status")["status"] == "error"
+    finally:
+        os.chdir(cwd)
+        pirec.isrpi = isrpi
+        del sys.modules["picamera"]
+        if home is not None:
+            os.environ["HOME"] = home
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+
+    print("TEST: camera warm-up convergence with a stubbed camera")
+    test_converge()
+    print("DONE..\n")
+
+    print("TEST: converting start times to deadlines")
+    test_todeadline()
+    print("DONE..\n")
+
+    print("TEST: synchronised start of two agents on localhost")
+    test_sync_start()
+    print("DONE..\n")
+
+    print("TEST: no frames lost or duplicated between video segments")
+    test_segment_continuity()
+    print("DONE..\n")
+
+    print("TEST: detecting dropped frames in a stream with injected gaps")
+    test_dropped_frames()
+    print("DONE..\n")
+
+    print("TEST: motion activity and triggers from recorded motion vectors")
+    test_motion_offline()
+    print("DONE..\n")
+
+    print("TEST: streaming h264 into an mp4 container, and without ffmpeg")
+    test_mp4_container()
+    print("DONE..\n")
+
+    print("TEST: failed image writes are counted and do not stop the writers")
+    test_write_errors()
+    print("DONE..\n")
+
+    print("TEST: converting videos with a stub ffmpeg")
+    test_convert_stub()
+    print("DONE..\n")
+
+    print("TEST: live view server - snapshot and mjpeg stream")
+    test_liveview()
+    print("DONE..\n")
+
+    print("TEST: record, status, stop and reload of the daemon with a fake camera")
+    test_daemon()
+    print("DONE..\n")